@@ -0,0 +1,152 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+PUBLIC_DIR = "public"
+BUILD_DIR = os.environ.get("ASSET_BUILD_DIR", "public/_build")
+ASSET_URL = "/assets"
+# Widths of the WebP variants generated for images (never wider than the source).
+IMAGE_WIDTHS = [480, 960, 1600]
+WEBP_QUALITY = 80
+COMPRESSIBLE = (".css", ".js", ".svg", ".html", ".json", ".txt")
+IMAGES = (".jpg", ".jpeg", ".png")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+logger = logging.getLogger("training.assets")
+
+# Logical path under public/ -> {"url": hashed url, "width": ..., "webp": [{"width", "url"}]}
+manifest = {}
+
+
+def hashed_name(path: str, digest: str, suffix: str = None):
+    base, extension = os.path.splitext(path)
+    return f"{base}.{digest}{suffix or extension}"
+
+
+def write_once(destination: str, write):
+    # Output names include the content hash, so an existing file is already up to date.
+    if os.path.exists(destination):
+        return
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    # Per-process temp name: every worker builds the assets on startup.
+    temp_path = f"{destination}.{os.getpid()}.part"
+    write(temp_path)
+    os.replace(temp_path, destination)
+
+
+def write_bytes(data: bytes):
+    def write(temp_path):
+        with open(temp_path, "wb") as out_file:
+            out_file.write(data)
+    return write
+
+
+def precompress(path: str):
+    with open(path, "rb") as in_file:
+        data = in_file.read()
+    write_once(f"{path}.gz", write_bytes(gzip.compress(data, 9)))
+    if brotli is not None:
+        write_once(f"{path}.br", write_bytes(brotli.compress(data, quality=11)))
+
+
+def image_variants(source: str, name: str, digest: str):
+    if Image is None:
+        return None, []
+    with Image.open(source) as image:
+        width = image.width
+        variants = []
+        for variant_width in IMAGE_WIDTHS + [width]:
+            if variant_width > width or any(variant["width"] == variant_width for variant in variants):
+                continue
+            variant_name = hashed_name(name, digest, f".{variant_width}w.webp")
+            def write(temp_path, variant_width=variant_width):
+                resized = image.resize((variant_width, round(image.height * variant_width / width)), Image.LANCZOS) if variant_width != width else image
+                resized.save(temp_path, "WEBP", quality=WEBP_QUALITY)
+            write_once(os.path.join(BUILD_DIR, variant_name), write)
+            variants.append({"width": variant_width, "url": f"{ASSET_URL}/{variant_name}"})
+    return width, variants
+
+
+def build_assets():
+    # Copy public/ into BUILD_DIR under content-hashed names, precompress text
+    # assets and write WebP variants of images. Safe to run on every startup:
+    # unchanged files are skipped.
+    built = {}
+    for root, dirs, files in os.walk(PUBLIC_DIR):
+        dirs[:] = [directory for directory in dirs if os.path.join(root, directory) != os.path.normpath(BUILD_DIR)]
+        for file in files:
+            source = os.path.join(root, file)
+            name = os.path.relpath(source, PUBLIC_DIR).replace(os.sep, "/")
+            with open(source, "rb") as in_file:
+                digest = hashlib.sha256(in_file.read()).hexdigest()[:12]
+            output_name = hashed_name(name, digest)
+            destination = os.path.join(BUILD_DIR, output_name)
+            write_once(destination, lambda temp_path: shutil.copyfile(source, temp_path))
+            entry = {"url": f"{ASSET_URL}/{output_name}"}
+            if file.lower().endswith(COMPRESSIBLE):
+                precompress(destination)
+            if file.lower().endswith(IMAGES):
+                entry["width"], entry["webp"] = image_variants(source, name, digest)
+            built[name] = entry
+    manifest_path = os.path.join(BUILD_DIR, "manifest.json")
+    temp_path = f"{manifest_path}.{os.getpid()}.part"
+    with open(temp_path, "w") as manifest_file:
+        json.dump(built, manifest_file, indent=1)
+    os.replace(temp_path, manifest_path)
+    manifest.clear()
+    manifest.update(built)
+    logger.info("built %d assets into %s", len(built), BUILD_DIR)
+    return built
+
+
+def asset_url(name: str):
+    entry = manifest.get(name)
+    return entry["url"] if entry else f"/public/{name}"
+
+
+def asset_srcset(name: str):
+    entry = manifest.get(name) or {}
+    return ", ".join(f"{variant['url']} {variant['width']}w" for variant in entry.get("webp") or [])
+
+
+def register(templates):
+    templates.env.globals.update(asset_url=asset_url, asset_srcset=asset_srcset)
+
+
+class ImmutableStaticFiles(StaticFiles):
+    # Serves BUILD_DIR: every name is content-hashed, so it can be cached
+    # forever. Precompressed .br/.gz siblings are used when the client accepts them.
+    async def get_response(self, path: str, scope):
+        accept_encoding = dict(scope["headers"]).get(b"accept-encoding", b"").decode()
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in accept_encoding and path.endswith(COMPRESSIBLE):
+                full_path, stat_result = self.lookup_path(path + suffix)
+                if stat_result is not None:
+                    response = self.file_response(full_path, stat_result, scope)
+                    response.headers["content-encoding"] = encoding
+                    response.headers["content-type"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                    response.headers["vary"] = "Accept-Encoding"
+                    response.headers["cache-control"] = IMMUTABLE
+                    return response
+        response = await super().get_response(path, scope)
+        response.headers["cache-control"] = IMMUTABLE
+        if path.endswith(COMPRESSIBLE):
+            response.headers["vary"] = "Accept-Encoding"
+        return response
@@ -0,0 +1,61 @@
+"""Compare assigning a video to a whole site one user at a time vs. in bulk.
+
+Needs a running mongod. Uses its own database, which is dropped afterwards:
+
+    MONGO_DB=train_bench python -m bench.bench_assign --users 300
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("MONGO_DB", "train_bench")
+
+import database
+from routers import assignments, users
+
+
+async def seed(count: int):
+    await database.user_collection.delete_many({})
+    await database.user_collection.insert_many([
+        {"name": f"User {i}", "role": "miner", "user_name": f"user{i}", "email": f"user{i}@example.com", "password": "x", "admin": False, "content_assigned": [], "content_completed": [], "quiz_scores": []}
+        for i in range(count)
+    ])
+
+
+async def run(args):
+    if database.MONGO_DB == "train":
+        raise SystemExit("Refusing to run against the production database; set MONGO_DB.")
+    await database.ensure_indexes()
+    try:
+        await seed(args.users)
+        database.query_monitor.commands = 0
+        began = time.perf_counter()
+        for i in range(args.users):
+            await users.assign_user_content(f"user{i}", "safety.mp4")
+        loop_time = time.perf_counter() - began
+        loop_commands = database.query_monitor.commands
+
+        await seed(args.users)
+        database.query_monitor.commands = 0
+        began = time.perf_counter()
+        await assignments.assign_videos({"role": "miner"}, ["safety.mp4"])
+        bulk_time = time.perf_counter() - began
+        bulk_commands = database.query_monitor.commands
+    finally:
+        await database.client.drop_database(database.MONGO_DB)
+
+    print(f"users:   {args.users}")
+    print(f"loop:    {loop_time * 1000:9.1f} ms  {loop_commands} mongo commands")
+    print(f"bulk:    {bulk_time * 1000:9.1f} ms  {bulk_commands} mongo commands")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=300)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compare the old glob scan in get_video_by_uuid with the indexed catalog.
+
+    python -m bench.bench_catalog --videos 10000
+"""
+import argparse
+import asyncio
+import glob
+import os
+import re
+import tempfile
+import time
+import uuid
+
+from routers import vids
+
+
+def glob_lookup(video_name: str):
+    # The lookup get_video_by_uuid did before the catalog existed.
+    vids_found = glob.glob("./vids/**/*.mp4", recursive=True)
+    video = vids.Video()
+    for vid in vids_found:
+        video_pattern = re.search(video_name, vid)
+        if video_pattern:
+            video_path = re.sub(video_name, " ", video_pattern.string).rstrip()
+            quizzes = glob.glob(f"{video_path}*.txt", recursive=True)
+            if len(quizzes) == 1:
+                video.quiz = quizzes[0]
+            video.mp4 = video_pattern.string
+    return video
+
+
+def seed(count: int):
+    names = []
+    for i in range(count):
+        id = str(uuid.uuid4())
+        path = os.path.join("vids", id)
+        os.makedirs(path)
+        open(os.path.join(path, f"training_{i}.mp4"), "wb").close()
+        open(os.path.join(path, f"training_{i}.txt"), "w").close()
+        names.append(f"training_{i}.mp4")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--videos", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        names = seed(args.videos)
+        sample = names[:: max(1, len(names) // args.lookups)][: args.lookups]
+
+        start = time.perf_counter()
+        for name in sample:
+            glob_lookup(name)
+        glob_time = (time.perf_counter() - start) / len(sample)
+
+        start = time.perf_counter()
+        for entry in os.scandir(vids.VIDS_DIR):
+            vids.add_to_catalog(vids.scan_video_dir(entry.name))
+        build_time = time.perf_counter() - start
+
+        async def lookups():
+            start = time.perf_counter()
+            for name in sample:
+                await vids.get_video_by_uuid(name)
+            return (time.perf_counter() - start) / len(sample)
+
+        catalog_time = asyncio.run(lookups())
+
+    print(f"videos:             {args.videos}")
+    print(f"glob lookup:        {glob_time * 1000:10.3f} ms")
+    print(f"catalog build:      {build_time * 1000:10.3f} ms (once, at startup)")
+    print(f"catalog lookup:     {catalog_time * 1000:10.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Stream a large completion export and check it stays under a memory ceiling.
+
+    python -m bench.bench_export --rows 1000000 --max-rss-mb 150
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+from routers import reports
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+async def completions(rows: int):
+    # Stands in for the Mongo cursor: yields documents one at a time.
+    started = datetime(2026, 1, 1)
+    for i in range(rows):
+        yield {"completed_at": started + timedelta(seconds=i), "user_name": f"user{i % 5000}", "role": f"role{i % 12}", "video": f"video{i % 300}.mp4", "uuid": "0" * 36, "score": (i % 100) * 1.0}
+
+
+async def run(rows: int, format: str, gzip: bool):
+    response = reports.export_response(completions(rows), format, "gzip" if gzip else None)
+    sent = 0
+    peak = 0.0
+    began = time.perf_counter()
+    async for chunk in response.body_iterator:
+        sent += len(chunk)
+        peak = max(peak, rss_mb())
+    return sent, peak, time.perf_counter() - began
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--max-rss-mb", type=float, default=150)
+    parser.add_argument("--formats", nargs="+", default=["csv", "ndjson", "xlsx"])
+    args = parser.parse_args()
+
+    failed = False
+    for format in args.formats:
+        for gzip in ([False, True] if format != "xlsx" else [False]):
+            sent, peak, elapsed = asyncio.run(run(args.rows, format, gzip))
+            label = f"{format}{'+gzip' if gzip else ''}"
+            print(f"{label:12s} {args.rows} rows  {sent / 1024 / 1024:8.1f} MB  {elapsed:6.1f}s  rss {peak:6.1f} MB")
+            failed = failed or peak > args.max_rss_mb
+    print(f"peak rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB (ceiling {args.max_rss_mb} MB)")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
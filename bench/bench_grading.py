@@ -0,0 +1,49 @@
+"""Micro-benchmark the old nested-loop scorer against Quiz.grade.
+
+    python -m bench.bench_grading --questions 100 1000
+"""
+import argparse
+import timeit
+
+from quizzes import Question, Quiz
+
+
+def score_quiz_nested(quiz: Quiz, answers: list[str]):
+    # What Quiz.score_quiz did: every question against every answer.
+    correct_count = 0
+    for question in quiz.questions:
+        for answer in answers:
+            if answer in question.correct_answer.replace("Answer: ", ""):
+                correct_count += 1
+    return (correct_count / len(quiz.questions)) * 100
+
+
+def build_quiz(count: int):
+    questions = []
+    for i in range(count):
+        options = [f"Option{j}: answer {i}-{j}" for j in range(4)]
+        questions.append(Question(f"Question {i}?", options, f" answer {i}-{i % 4}"))
+    return Quiz(questions)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--submissions", type=int, default=1000)
+    args = parser.parse_args()
+
+    for count in args.questions:
+        quiz = build_quiz(count)
+        answers = {f"q{i}": question.option_text(question.options[i % 4]) for i, question in enumerate(quiz.questions)}
+        answer_list = list(answers.values())
+        assert quiz.grade(answers)["score"] == 100
+
+        runs = max(1, 10000 // count)
+        nested = min(timeit.repeat(lambda: score_quiz_nested(quiz, answer_list), number=runs, repeat=3)) / runs
+        keyed = min(timeit.repeat(lambda: quiz.grade(answers), number=runs, repeat=3)) / runs
+        batch = min(timeit.repeat(lambda: quiz.grade_many([answers] * args.submissions), number=1, repeat=3))
+        print(f"{count:5d} questions: nested {nested * 1000:9.3f} ms   keyed {keyed * 1000:7.3f} ms   regrade {args.submissions} submissions {batch * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
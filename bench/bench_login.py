@@ -0,0 +1,124 @@
+"""Login latency for real users while a credential-stuffing burst hits the same process.
+
+Runs the same gate the login handler uses (throttle check, hash pool,
+failure recording) against in-memory users, so it doesn't need Mongo:
+
+    python -m bench.bench_login --users 500 --attack-rate 1000 --attackers 20
+"""
+import argparse
+import asyncio
+import secrets
+import statistics
+import sys
+import time
+
+import passwords
+
+
+async def attempt(users: dict, user_name: str, password: str, address: str):
+    # Mirrors routers.users.login without the template rendering.
+    if passwords.login_retry_after(user_name, address):
+        return "throttled"
+    priority = passwords.login_priority(address)
+    with passwords.login_in_flight(address):
+        try:
+            matched = await passwords.verify_password(password, users.get(user_name), priority)
+        except passwords.HashPoolBusy:
+            return "busy"
+    if matched:
+        passwords.user_throttle.reset(user_name)
+        return "ok"
+    passwords.user_throttle.record(user_name)
+    passwords.ip_throttle.record(address)
+    return "failed"
+
+
+async def legit_logins(users: dict, concurrency: int, network: int):
+    # Each real user logs in once from their own address.
+    latencies = []
+    queue = list(enumerate(users))
+
+    async def client():
+        while queue:
+            i, user_name = queue.pop()
+            began = time.perf_counter()
+            result = await attempt(users, user_name, f"pw-{user_name}", f"10.{network}.{i // 256}.{i % 256}")
+            latencies.append(time.perf_counter() - began)
+            assert result == "ok", result
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies
+
+
+async def stuffing(users: dict, rate: int, attackers: int, stop: asyncio.Event):
+    # Fires `rate` attempts a second from `attackers` addresses until stopped,
+    # without waiting for earlier attempts to finish.
+    results = {}
+    pending = set()
+
+    async def one(i: int):
+        result = await attempt(users, f"victim{i % 1000}", secrets.token_hex(4), f"203.0.113.{i % attackers}")
+        results[result] = results.get(result, 0) + 1
+
+    i = 0
+    while not stop.is_set():
+        for _ in range(rate // 100):
+            task = asyncio.create_task(one(i))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            i += 1
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*pending)
+    return i, results
+
+
+async def loop_lag(stop: asyncio.Event):
+    lags = []
+    while not stop.is_set():
+        began = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - began - 0.005)
+    return lags
+
+
+def p99(values: list[float]):
+    return statistics.quantiles(values, n=100)[98] * 1000
+
+
+async def run(args):
+    users = {f"user{i}": passwords.hash_password_sync(f"pw-user{i}") for i in range(args.users)}
+    passwords.dummy_hash()
+
+    baseline = await legit_logins(users, args.concurrency, 0)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(loop_lag(stop))
+    attack = asyncio.create_task(stuffing(users, args.attack_rate, args.attackers, stop))
+    under_attack = await legit_logins(users, args.concurrency, 1)
+    stop.set()
+    attempts, results = await attack
+    lags = await lag_task
+    return baseline, under_attack, attempts, results, lags
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--attack-rate", type=int, default=1000)
+    parser.add_argument("--attackers", type=int, default=20)
+    parser.add_argument("--max-p99-ratio", type=float, default=3.0)
+    args = parser.parse_args()
+
+    baseline, under_attack, attempts, results, lags = asyncio.run(run(args))
+    print(f"hash workers: {passwords.PASSWORD_HASH_WORKERS}  scrypt n={passwords.PASSWORD_SCRYPT_N}")
+    print(f"baseline:     p50 {statistics.median(baseline) * 1000:7.1f} ms  p99 {p99(baseline):7.1f} ms")
+    print(f"under attack: p50 {statistics.median(under_attack) * 1000:7.1f} ms  p99 {p99(under_attack):7.1f} ms")
+    print(f"attack:       {attempts} attempts from {args.attackers} addresses -> {results}")
+    print(f"loop lag:     p99 {p99(lags):7.1f} ms")
+    if p99(under_attack) > p99(baseline) * args.max_p99_ratio:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
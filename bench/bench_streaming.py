@@ -0,0 +1,80 @@
+"""Seek-heavy concurrent clients against stream_video, measuring event loop lag.
+
+    python -m bench.bench_streaming --clients 50 --seeks 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from routers import vids
+
+
+async def seeker(client: httpx.AsyncClient, url: str, size: int, seeks: int, latencies: list):
+    for _ in range(seeks):
+        start = random.randrange(size - 1)
+        end = min(size - 1, start + random.randrange(64 * 1024, 1024 * 1024))
+        began = time.perf_counter()
+        response = await client.get(url, headers={"Range": f"bytes={start}-{end}"})
+        assert response.status_code == 206
+        latencies.append(time.perf_counter() - began)
+
+
+async def loop_lag(stop: asyncio.Event, lags: list):
+    # A healthy event loop wakes this task up roughly every 10ms.
+    while not stop.is_set():
+        began = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - began - 0.01)
+
+
+async def run(args):
+    app = FastAPI()
+    app.include_router(vids.router)
+    vids.add_to_catalog(vids.scan_video_dir("bench"))
+    size = os.path.getsize(vids.catalog["bench"].mp4)
+    url = "/video/vids/bench/bench.mp4"
+
+    latencies, lags = [], []
+    stop = asyncio.Event()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        probe = asyncio.create_task(loop_lag(stop, lags))
+        began = time.perf_counter()
+        await asyncio.gather(*(seeker(client, url, size, args.seeks, latencies) for _ in range(args.clients)))
+        elapsed = time.perf_counter() - began
+        stop.set()
+        await probe
+
+    latencies.sort()
+    lags.sort()
+    print(f"requests:      {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} req/s)")
+    print(f"latency p50:   {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"latency p99:   {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms")
+    print(f"loop lag p99:  {lags[int(len(lags) * 0.99) - 1] * 1000:.1f} ms")
+    print(f"loop lag max:  {lags[-1] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--seeks", type=int, default=20)
+    parser.add_argument("--size-mb", type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        os.makedirs("vids/bench")
+        with open("vids/bench/bench.mp4", "wb") as video_file:
+            video_file.write(os.urandom(args.size_mb * 1024 * 1024))
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
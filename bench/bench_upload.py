@@ -0,0 +1,88 @@
+"""Stream a large upload while other requests are served, reporting RSS and p99.
+
+    python -m bench.bench_upload --size-mb 2048
+"""
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from dependencies import require_admin
+from routers import vids
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+async def video_bytes(size: int, sampled: list):
+    block = os.urandom(256 * 1024)
+    sent = 0
+    while sent < size:
+        chunk = block[: min(len(block), size - sent)]
+        sent += len(chunk)
+        sampled.append(rss_mb())
+        yield chunk
+
+
+async def other_requests(client: httpx.AsyncClient, stop: asyncio.Event, latencies: list):
+    while not stop.is_set():
+        began = time.perf_counter()
+        response = await client.get("/video/vids/probe/probe.mp4", headers={"Range": "bytes=0-65535"})
+        assert response.status_code == 206
+        latencies.append(time.perf_counter() - began)
+        await asyncio.sleep(0.005)
+
+
+async def run(args):
+    app = FastAPI()
+    app.include_router(vids.router)
+    # Uploads are admin-only; the bench measures streaming, not sessions.
+    app.dependency_overrides[require_admin] = lambda: {"user_name": "bench", "admin": True}
+    vids.add_to_catalog(vids.scan_video_dir("probe"))
+    size = args.size_mb * 1024 * 1024
+
+    latencies, sampled = [], []
+    stop = asyncio.Event()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        upload = (await client.post("/uploads", data={"filename": "large.mp4", "size": size})).json()
+        probe = asyncio.create_task(other_requests(client, stop, latencies))
+        began = time.perf_counter()
+        response = await client.patch(f"/uploads/{upload['upload_id']}", headers={"Upload-Offset": "0"}, content=video_bytes(size, sampled))
+        elapsed = time.perf_counter() - began
+        stop.set()
+        await probe
+        assert response.headers["Upload-Offset"] == str(size)
+
+    latencies.sort()
+    print(f"uploaded:          {args.size_mb} MB in {elapsed:.2f}s")
+    print(f"rss during upload: {min(sampled):.0f} - {max(sampled):.0f} MB")
+    print(f"peak rss:          {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    print(f"other requests:    {len(latencies)}")
+    print(f"other p50:         {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"other p99:         {latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=2048)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        os.makedirs("vids/probe")
+        with open("vids/probe/probe.mp4", "wb") as video_file:
+            video_file.write(os.urandom(1024 * 1024))
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
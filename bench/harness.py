@@ -0,0 +1,286 @@
+"""Load test the site's hot paths against the in-process app and compare with a stored baseline.
+
+Seeds synthetic users, videos, quizzes and completions, then drives login, the
+index, the video page, quiz submission, the admin pages, the logs and video
+range requests through the ASGI app. Reports throughput, p50/p99 latency and
+peak RSS, and exits non-zero when a flow fails or regresses past the baseline.
+
+Against a local mongod (uses its own database, dropped afterwards):
+
+    python -m bench.harness --users 500 --videos 50
+
+Without a server, using mongomock-motor:
+
+    python -m bench.harness --mongo mock
+
+Record a new baseline after an intentional change:
+
+    python -m bench.harness --mongo mock --update-baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(REPO, "bench", "baseline.json")
+PASSWORD = "bench-password"
+QUESTIONS = 10
+RANGE_BYTES = 256 * 1024
+
+# Must be set before the app modules read them.
+os.environ.setdefault("MONGO_DB", "train_bench")
+os.environ.setdefault("MEDIA_WORKERS", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("SESSION_SECRET", "bench")
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def use_mock_mongo():
+    import database
+    from mongomock_motor import AsyncMongoMockClient
+
+    database.client = AsyncMongoMockClient()
+    database.db = database.client[database.MONGO_DB]
+    for name in ("user", "vid", "completion", "group", "job"):
+        setattr(database, f"{name}_collection", database.db[getattr(database, f"{name}_collection").name])
+
+
+def quiz_text(number: int):
+    blocks = []
+    for question in range(QUESTIONS):
+        options = [f"Option{option + 1}: Answer {number}-{question}-{option}" for option in range(4)]
+        blocks.append("\n".join([f"Question: Video {number} question {question}?", *options, f"Answer: Answer {number}-{question}-0"]))
+    return "\n\n".join(blocks) + "\n\nEnd\n"
+
+
+def seed_files(args):
+    videos = []
+    payload = os.urandom(1024 * 1024)
+    for number in range(args.videos):
+        video_uuid = str(uuid.uuid4())
+        path = os.path.join("vids", video_uuid)
+        os.makedirs(path)
+        with open(os.path.join(path, f"video{number}.mp4"), "wb") as video_file:
+            for _ in range(args.video_mb):
+                video_file.write(payload)
+        with open(os.path.join(path, f"quiz{number}.txt"), "w") as quiz_file:
+            quiz_file.write(quiz_text(number))
+        videos.append((video_uuid, f"video{number}.mp4", number))
+    return videos
+
+
+async def seed_mongo(args, videos):
+    import database
+    import passwords
+
+    password = passwords.hash_password_sync(PASSWORD)
+    names = [filename for _, filename, _ in videos]
+    users = [{
+        "name": f"User {i}", "role": f"role{i % 10}", "user_name": f"user{i}", "email": f"user{i}@example.com", "password": password, "admin": False,
+        "content_assigned": names[i % len(names):][:5], "content_completed": [], "quiz_scores": [],
+    } for i in range(args.users)]
+    users.append({"name": "Admin", "role": "admin", "user_name": "admin", "email": "admin@example.com", "password": password, "admin": True, "content_assigned": [], "content_completed": [], "quiz_scores": []})
+    await database.user_collection.insert_many(users)
+    started = time.time()
+    await database.completion_collection.insert_many([{
+        "user_name": f"user{i % args.users}", "role": f"role{i % 10}", "uuid": videos[i % len(videos)][0], "video": f"old{i}.mp4",
+        "answers": {}, "score": float(i % 100), "results": [], "completed_at": datetime.fromtimestamp(started - i),
+    } for i in range(args.completions)])
+
+
+def flows(args, videos, sessions):
+    # Each flow takes a request number and returns (method, url, kwargs, expected status).
+    def login(i):
+        return "POST", "/login", {"data": {"user_name": f"user{i % args.users}", "password": PASSWORD}}, 200
+
+    def index(i):
+        return "GET", "/", {"headers": sessions(f"user{i % args.users}")}, 200
+
+    def video_page(i):
+        return "GET", f"/v/video/{videos[i % len(videos)][0]}", {"headers": sessions(f"user{i % args.users}")}, 200
+
+    def quiz(i):
+        # Each (user, video) pair submits once; a second submission would be a 409.
+        user, (video_uuid, filename, number) = f"user{i % args.users}", videos[(i // args.users) % len(videos)]
+        answers = {f"q{question}": f"Answer {number}-{question}-{random.randrange(4)}" for question in range(QUESTIONS)}
+        return "POST", f"/user/{user}/content/vids/{video_uuid}/{filename}/c", {"data": answers, "headers": sessions(user)}, 302
+
+    def administration(i):
+        return "GET", "/v/administration", {"headers": sessions("admin")}, 200
+
+    def logs(i):
+        return "GET", "/v/logs", {"headers": sessions("admin")}, 200
+
+    def video_range(i):
+        video_uuid, filename, _ = videos[i % len(videos)]
+        start = random.randrange(0, args.video_mb * 1024 * 1024 - RANGE_BYTES)
+        return "GET", f"/video/vids/{video_uuid}/{filename}", {"headers": {**sessions(f"user{i % args.users}"), "range": f"bytes={start}-{start + RANGE_BYTES - 1}"}}, 206
+
+    return {"login": login, "index": index, "video": video_page, "quiz": quiz, "administration": administration, "logs": logs, "range": video_range}
+
+
+async def drive(client, flow, requests: int, concurrency: int):
+    latencies = []
+    errors = []
+    sent = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal sent
+        for i in remaining:
+            method, url, kwargs, expected = flow(i)
+            began = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - began)
+            sent += len(response.content)
+            if response.status_code != expected:
+                errors.append(f"{method} {url} -> {response.status_code}")
+
+    began = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - began
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(statistics.quantiles(latencies, n=100)[98] * 1000, 2),
+        "mb_sent": round(sent / 1024 / 1024, 2),
+        "rss_mb": round(rss_mb(), 1),
+    }, errors[:5]
+
+
+async def run(args):
+    import httpx
+
+    if args.mongo == "mock":
+        use_mock_mongo()
+    import database
+    import main
+    from dependencies import sign_session
+
+    if database.MONGO_DB == "train":
+        raise SystemExit("Refusing to run against the production database; set MONGO_DB.")
+    await database.client.drop_database(database.MONGO_DB)
+    videos = seed_files(args)
+    await seed_mongo(args, videos)
+
+    tokens = {}
+
+    def sessions(user_name: str):
+        if user_name not in tokens:
+            tokens[user_name] = sign_session(user_name)
+        return {"cookie": f"session={tokens[user_name]}"}
+
+    results = {}
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            if args.mongo == "mock":
+                # mongomock checks a unique index by scanning the whole collection on every
+                # insert, even for documents outside its partial filter. Mongo skips those, so
+                # keeping it would only bill the quiz flow for a cost production doesn't pay.
+                await database.completion_collection.drop_index("user_name_1_video_1_completed_at_1")
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                for name, flow in flows(args, videos, sessions).items():
+                    if args.flows and name not in args.flows:
+                        continue
+                    requests = min(args.requests, args.users * len(videos)) if name == "quiz" else args.requests
+                    results[name], errors = await drive(client, flow, requests, args.concurrency)
+                    for error in errors:
+                        print(f"  {name}: {error}", file=sys.stderr)
+    finally:
+        await database.client.drop_database(database.MONGO_DB)
+    return results
+
+
+def scale(args):
+    return {"mongo": args.mongo, "users": args.users, "videos": args.videos, "completions": args.completions, "video_mb": args.video_mb, "requests": args.requests, "concurrency": args.concurrency}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, slack_ms: float):
+    failures = []
+    for name, result in results.items():
+        if result["errors"]:
+            failures.append(f"{name}: {result['errors']} requests failed")
+        before = baseline.get("flows", {}).get(name)
+        if before is None:
+            continue
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance) + slack_ms:
+            failures.append(f"{name}: p99 {result['p99_ms']} ms vs baseline {before['p99_ms']} ms")
+        if result["rps"] < before["rps"] * (1 - tolerance):
+            failures.append(f"{name}: {result['rps']} req/s vs baseline {before['rps']} req/s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo", choices=["local", "mock"], default="local")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--videos", type=int, default=20)
+    parser.add_argument("--completions", type=int, default=5000)
+    parser.add_argument("--video-mb", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--flows", nargs="+")
+    parser.add_argument("--baseline", default=BASELINE)
+    # Allowed slowdown before a flow counts as a regression; machines are noisy.
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    # Absolute p99 allowance, so a GC pause on a 2 ms flow isn't a regression.
+    parser.add_argument("--slack-ms", type=float, default=25)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    random.seed(0)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    # The app uses paths relative to the working directory (./vids, templates, public).
+    for name in ("templates", "public"):
+        os.symlink(os.path.join(REPO, name), os.path.join(workdir, name))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'flow':15s} {'requests':>8s} {'errors':>6s} {'req/s':>8s} {'p50 ms':>8s} {'p99 ms':>8s} {'MB sent':>8s} {'rss MB':>7s}")
+    for name, result in results.items():
+        print(f"{name:15s} {result['requests']:8d} {result['errors']:6d} {result['rps']:8.1f} {result['p50_ms']:8.2f} {result['p99_ms']:8.2f} {result['mb_sent']:8.2f} {result['rss_mb']:7.1f}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"scale": scale(args), "flows": results}, baseline_file, indent=2)
+            baseline_file.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("scale") != scale(args):
+            print("baseline was recorded at a different scale; only checking for errors")
+            baseline = {}
+    failures = compare(results, baseline, args.tolerance, args.slack_ms)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
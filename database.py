@@ -0,0 +1,138 @@
+import logging
+import os
+import time
+
+import motor.motor_asyncio
+from pymongo import ASCENDING, monitoring
+
+import metrics
+
+
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://127.0.0.1:27017")
+MONGO_DB = os.environ.get("MONGO_DB", "train")
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_TIMEOUT_MS = int(os.environ.get("MONGO_TIMEOUT_MS", 5000))
+MONGO_SLOW_QUERY_MS = int(os.environ.get("MONGO_SLOW_QUERY_MS", 100))
+
+logger = logging.getLogger("training.database")
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    # Tracks how many connections are open and checked out of the pool.
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkout_failures = 0
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_ready(self, event): pass
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def stats(self):
+        return {"open": self.open, "checked_out": self.checked_out, "max_checked_out": self.max_checked_out, "checkout_failures": self.checkout_failures, "max_pool_size": MONGO_MAX_POOL_SIZE}
+
+
+class QueryMonitor(monitoring.CommandListener):
+    # Counts commands and logs any that take longer than MONGO_SLOW_QUERY_MS.
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.slow = 0
+        self.total_ms = 0.0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.failures += 1
+        self.record(event)
+
+    def record(self, event):
+        duration_ms = event.duration_micros / 1000
+        metrics.record_mongo_command(event.command_name, duration_ms / 1000)
+        self.commands += 1
+        self.total_ms += duration_ms
+        if duration_ms >= MONGO_SLOW_QUERY_MS:
+            self.slow += 1
+            logger.warning("slow mongo command %s on %s took %.1fms", event.command_name, event.database_name, duration_ms)
+
+    def stats(self):
+        return {"commands": self.commands, "failures": self.failures, "slow": self.slow, "total_ms": round(self.total_ms, 3)}
+
+
+pool_monitor = PoolMonitor()
+query_monitor = QueryMonitor()
+
+# The one client for the whole app; every router uses the collections below.
+client = motor.motor_asyncio.AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_TIMEOUT_MS,
+    event_listeners=[pool_monitor, query_monitor],
+)
+db = client[MONGO_DB]
+
+user_collection = db.get_collection("users")
+vid_collection = db.get_collection("vids")
+completion_collection = db.get_collection("completions")
+group_collection = db.get_collection("groups")
+job_collection = db.get_collection("jobs")
+
+
+async def ensure_indexes():
+    started = time.perf_counter()
+    await user_collection.create_index("user_name", unique=True)
+    await user_collection.create_index([("role", ASCENDING), ("user_name", ASCENDING)])
+    await user_collection.create_index([("name", ASCENDING), ("user_name", ASCENDING)])
+    await user_collection.create_index([("email", ASCENDING), ("user_name", ASCENDING)])
+    await user_collection.create_index("content_assigned")
+    await user_collection.create_index("content_completed")
+    await user_collection.create_index("assignments.assigned_at")
+    await vid_collection.create_index("uuid", unique=True)
+    await vid_collection.create_index("filename")
+    await vid_collection.create_index("updated_at")
+    await completion_collection.create_index([("uuid", ASCENDING), ("user_name", ASCENDING)])
+    await completion_collection.create_index([("user_name", ASCENDING), ("completed_at", ASCENDING)])
+    await completion_collection.create_index([("video", ASCENDING), ("completed_at", ASCENDING)])
+    await completion_collection.create_index([("role", ASCENDING), ("completed_at", ASCENDING)])
+    await completion_collection.create_index([("completed_at", ASCENDING), ("_id", ASCENDING)])
+    # Every worker runs the completion string migration at startup; this keeps
+    # concurrent runs from inserting the same record twice.
+    await completion_collection.create_index([("user_name", ASCENDING), ("video", ASCENDING), ("completed_at", ASCENDING)], unique=True, partialFilterExpression={"migrated": True})
+    await group_collection.create_index("name", unique=True)
+    await job_collection.create_index([("kind", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)])
+    logger.info("mongo indexes ensured in %.1fms", (time.perf_counter() - started) * 1000)
+
+
+def close():
+    client.close()
+
+
+def stats():
+    return {"pool": pool_monitor.stats(), "queries": query_monitor.stats()}
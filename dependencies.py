@@ -0,0 +1,116 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Annotated
+
+from fastapi import Cookie, Depends, HTTPException
+
+from database import user_collection
+
+
+# The app refuses to start without SESSION_SECRET; the random fallback only
+# serves tests and scripts that import this module without the app.
+SESSION_SECRET = os.environ.get("SESSION_SECRET", secrets.token_hex(32)).encode()
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 60 * 60 * 12))
+SESSION_CACHE_TTL = int(os.environ.get("SESSION_CACHE_TTL", 300))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+
+
+class SessionCache:
+    # LRU of user_name -> user document with a TTL, so a stale document is
+    # never served for longer than `ttl` seconds even if an invalidation is missed.
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_name: str):
+        entry = self.entries.get(user_name)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_name)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user_name: str, user: dict):
+        self.entries[user_name] = (user, time.monotonic() + self.ttl)
+        self.entries.move_to_end(user_name)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_name: str):
+        self.entries.pop(user_name, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def _signature(payload: str):
+    digest = hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def session_version(user: dict):
+    # Bumped on logout, which revokes every token signed with the old value.
+    return user.get("session_version", 0)
+
+
+def sign_session(user_name: str, version: int = 0):
+    payload = base64.urlsafe_b64encode(f"{user_name}|{int(time.time())}|{version}".encode()).decode()
+    return f"{payload}.{_signature(payload)}"
+
+
+def read_session(token: str):
+    # Return (user name, session version) from a session token, or None if it is forged or expired.
+    payload, _, signature = token.rpartition(".")
+    if not payload or not hmac.compare_digest(signature, _signature(payload)):
+        return None
+    try:
+        user_name, issued, version = base64.urlsafe_b64decode(payload.encode()).decode().rsplit("|", 2)
+        issued = int(issued)
+        version = int(version)
+    except ValueError:
+        return None
+    if issued + SESSION_TTL < time.time():
+        return None
+    return user_name, version
+
+
+def is_admin(user: dict):
+    return user.get("admin") in (True, "True", "true", "on")
+
+
+async def get_current_user(session: Annotated[str | None, Cookie()] = None):
+    if session is None:
+        return None
+    session = read_session(session)
+    if session is None:
+        return None
+    user_name, version = session
+    user = session_cache.get(user_name)
+    if user is None:
+        user = await user_collection.find_one({"user_name": user_name})
+        if user is not None:
+            session_cache.put(user_name, user)
+    if user is None or session_version(user) != version:
+        return None
+    return user
+
+
+async def require_admin(user: Annotated[dict | None, Depends(get_current_user)]):
+    if user is None:
+        raise HTTPException(status_code=401)
+    if not is_admin(user):
+        raise HTTPException(status_code=403)
+    return user
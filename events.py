@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+
+from pymongo.errors import PyMongoError
+
+import database
+
+
+logger = logging.getLogger("training.events")
+
+# Where dashboard updates come from. "local": the handlers that make a change
+# announce it, which only reaches streams served by the same process.
+# "changestream": each process follows Mongo change streams on the user and
+# completion collections, so every worker sees every change (needs a replica set).
+EVENTS_SOURCE = os.environ.get("EVENTS_SOURCE", "local")
+# Messages buffered per open stream; a client that falls further behind is told to reload.
+EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", 100))
+# Seconds between keep-alive comments, so proxies don't drop idle streams.
+EVENTS_KEEPALIVE = int(os.environ.get("EVENTS_KEEPALIVE", 15))
+CHANGE_STREAM_RETRY = 5
+
+KEEPALIVE = ": keep-alive\n\n"
+
+
+def format_event(event: str, data: str):
+    return f"event: {event}\n" + "".join(f"data: {line}\n" for line in data.splitlines() or [""]) + "\n"
+
+
+RELOAD = format_event("reload", "")
+
+
+class Broker:
+    # Fans each message out to every open stream in this process. Messages are
+    # formatted once, however many dashboards are open.
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.published = 0
+        self.reloads = 0
+        self.closed = False
+
+    def publish(self, event: str, data: str):
+        if not self.subscribers:
+            return
+        message = format_event(event, data)
+        self.published += 1
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too far behind to catch up message by message.
+                self.reloads += 1
+                self._replace(queue, RELOAD)
+
+    def _replace(self, queue: asyncio.Queue, message):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+    async def stream(self):
+        if self.closed:
+            # Draining for shutdown; the client reconnects to another node.
+            return
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    message = KEEPALIVE
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.subscribers.discard(queue)
+
+    def close(self):
+        # Ends every open stream, so shutdown doesn't wait on connected dashboards.
+        self.closed = True
+        for queue in self.subscribers:
+            self._replace(queue, None)
+
+    def stats(self):
+        return {"subscribers": len(self.subscribers), "published": self.published, "reloads": self.reloads}
+
+
+broker = Broker(EVENTS_QUEUE_SIZE)
+
+# kind -> async function(payloads) that renders and publishes a batch of changes.
+renderers = {}
+# Changes waiting for the dispatcher, by kind.
+pending = {}
+changes_waiting = asyncio.Event()
+tasks = []
+
+
+def renderer(kind: str):
+    def register(function):
+        renderers[kind] = function
+        return function
+    return register
+
+
+def notify(kind: str, payload):
+    if not broker.subscribers:
+        # Nobody is watching, so there is nothing to render.
+        return
+    pending.setdefault(kind, []).append(payload)
+    changes_waiting.set()
+
+
+def emit(kind: str, payload):
+    # Called by the handlers that make a change; ignored when change streams report changes instead.
+    if EVENTS_SOURCE == "local":
+        notify(kind, payload)
+
+
+async def dispatch():
+    # Changes that arrive while a batch is rendering are coalesced into the next
+    # batch, so a burst costs one render per kind rather than one per change.
+    while True:
+        await changes_waiting.wait()
+        changes_waiting.clear()
+        batch = dict(pending)
+        pending.clear()
+        for kind, payloads in batch.items():
+            try:
+                await renderers[kind](payloads)
+            except Exception:
+                logger.exception("could not publish %s events", kind)
+
+
+async def watch_changes():
+    pipeline = [{"$match": {
+        "ns.coll": {"$in": [database.user_collection.name, database.completion_collection.name]},
+        "operationType": {"$in": ["insert", "update", "replace"]},
+    }}]
+    while True:
+        try:
+            async with database.db.watch(pipeline, full_document="updateLookup") as changes:
+                async for change in changes:
+                    document = change.get("fullDocument")
+                    if document is None:
+                        continue
+                    if change["ns"]["coll"] == database.completion_collection.name:
+                        notify("completion", document)
+                    else:
+                        notify("user", document["user_name"])
+        except PyMongoError:
+            logger.warning("change stream failed; retrying in %ss", CHANGE_STREAM_RETRY, exc_info=True)
+            # Changes made while it was down are lost, so open dashboards refetch.
+            broker.publish("reload", "")
+            await asyncio.sleep(CHANGE_STREAM_RETRY)
+
+
+def start():
+    tasks.append(asyncio.create_task(dispatch()))
+    if EVENTS_SOURCE == "changestream":
+        tasks.append(asyncio.create_task(watch_changes()))
+
+
+async def stop():
+    broker.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import os
+import signal
+import threading
+
+
+# Seconds to keep serving after SIGTERM while /readyz reports 503, so a load
+# balancer stops routing here before the server closes its socket. Keep it
+# below the process manager's grace period (gunicorn's --graceful-timeout).
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", 0))
+
+logger = logging.getLogger("training.lifecycle")
+
+# Set once startup has finished; cleared again when draining starts.
+ready = False
+draining = False
+# Called as draining starts, e.g. to end long-lived streams.
+drain_callbacks = []
+# signal number -> the server's handler we wrapped
+server_handlers = {}
+
+
+def on_drain(callback):
+    drain_callbacks.append(callback)
+
+
+def install_drain_handler():
+    # Runs inside the server's lifespan, after uvicorn (or gunicorn's worker)
+    # has installed its own handlers; ours runs first and passes the signal on.
+    if threading.current_thread() is not threading.main_thread():
+        # Signals only reach the main thread, e.g. not a TestClient's portal.
+        return
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        server_handler = signal.getsignal(signum)
+        if not callable(server_handler) or server_handler is signal.default_int_handler:
+            continue
+        server_handlers[signum] = server_handler
+
+        def handle(signum, frame, server_handler=server_handler):
+            loop.call_soon_threadsafe(start_draining, server_handler, signum, frame)
+
+        signal.signal(signum, handle)
+
+
+def remove_drain_handler():
+    for signum, server_handler in server_handlers.items():
+        signal.signal(signum, server_handler)
+    server_handlers.clear()
+
+
+def start_draining(server_handler, signum: int, frame):
+    global ready, draining
+    if draining:
+        # A second signal skips the rest of the drain.
+        server_handler(signum, frame)
+        return
+    ready = False
+    draining = True
+    logger.info("draining for %ss before shutting down", SHUTDOWN_DRAIN_SECONDS)
+    for callback in drain_callbacks:
+        callback()
+    asyncio.get_running_loop().call_later(SHUTDOWN_DRAIN_SECONDS, server_handler, signum, frame)
@@ -1,41 +1,100 @@
+import asyncio
+import logging
+import os
 from typing import Annotated
-from fastapi import Cookie, FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from jinja2 import Template
 from pydantic import BeforeValidator
-import motor.motor_asyncio
+from contextlib import asynccontextmanager
 
-from routers import users, vids, admin, qrg
+import assets
+import database
+import events
+import lifecycle
+import media
+import metrics
+import migrations
+import passwords
+import templating
+from dependencies import get_current_user, session_cache
+from routers import users, vids, admin, qrg, reports, assignments, hls, health
+from templating import templates
 
-templates = Jinja2Templates(directory="templates")
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("training.main")
 
 
-client = motor.motor_asyncio.AsyncIOMotorClient("127.0.0.1:27017")
-db = client.train
-user_collection = db.get_collection('users')
-vid_collection = db.get_collection("vids")
 # Represents an ObjectId field in the database.
 # It will be represented as a `str` on the model so that it can be serialized to JSON.
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
-app = FastAPI();
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if "SESSION_SECRET" not in os.environ:
+        # A per-process random key would make workers reject each other's cookies.
+        raise RuntimeError("SESSION_SECRET must be set; use the same value for every worker and node")
+    lifecycle.install_drain_handler()
+    await run_in_threadpool(assets.build_assets)
+    await run_in_threadpool(templating.warm)
+    await run_in_threadpool(qrg.discover_guides)
+    await database.ensure_indexes()
+    await vids.reindex_videos()
+    await migrations.migrate_completion_strings({name: video.uuid for name, video in vids.catalog_by_name.items()})
+    media.start_workers()
+    events.start()
+    catalog_refresh = asyncio.create_task(vids.refresh_catalog())
+    lifecycle.ready = True
+    yield
+    # The server has stopped taking requests and finished the ones in flight.
+    lifecycle.ready = False
+    lifecycle.remove_drain_handler()
+    catalog_refresh.cancel()
+    await events.stop()
+    await media.stop_workers()
+    database.close()
+
+
+app = FastAPI(lifespan=lifespan);
+app.add_middleware(metrics.MetricsMiddleware)
 app.mount("/public", StaticFiles(directory="public"), name="public")
+app.mount(assets.ASSET_URL, assets.ImmutableStaticFiles(directory=assets.BUILD_DIR, check_dir=False), name="assets")
 app.include_router(admin.router)
 app.include_router(users.router)
 app.include_router(vids.router)
 app.include_router(qrg.router)
+app.include_router(reports.router)
+app.include_router(assignments.router)
+app.include_router(hls.router)
+app.include_router(health.router)
+
+# Open dashboard streams would otherwise hold up a graceful shutdown.
+lifecycle.on_drain(events.broker.close)
 
 
 @ app.get("/", response_description="Get the homepage.", response_class=HTMLResponse)
-async def index(request: Request, user: Annotated[str | None, Cookie()] = None):
+async def index(request: Request, user: Annotated[dict | None, Depends(get_current_user)]):
     context = {"request": request}
-    # Check if user is logged in, if not return log in page. (Cookies)
+    # Check if user is logged in, if not return log in page. (Session cookie)
     # If user is logged in return homepage.
     if user is not None:
-        user = await user_collection.find_one({"user_name": user})
         context = {"request": request, "user": user}
-        return templates.TemplateResponse("index.html", context)
+        return templates.TemplateResponse(request, "index.html", context)
     else:
-        return templates.TemplateResponse("login.html", context)
\ No newline at end of file
+        return templates.TemplateResponse(request, "login.html", context)
+
+metrics.register(metrics.Gauges("mongo_pool", "Mongo connection pool state.", database.pool_monitor.stats))
+metrics.register(metrics.Gauges("session_cache", "Session cache size and hit rate.", session_cache.stats))
+metrics.register(metrics.Gauges("password_hash_pool", "Password hashing pool state.", passwords.hash_pool.stats))
+metrics.register(metrics.Gauges("template_fragment_cache", "Template fragment cache size and hit rate.", templating.fragment_cache.stats))
+metrics.register(metrics.Gauges("admin_event_streams", "Open dashboard event streams and messages published.", events.broker.stats))
+
+
+@app.get("/metrics", response_description="Prometheus metrics.", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    if metrics.METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {metrics.METRICS_TOKEN}":
+        raise HTTPException(status_code=401)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
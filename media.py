@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.concurrency import run_in_threadpool
+from pymongo import ReturnDocument
+
+import storage
+from database import job_collection
+
+
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 1))
+MEDIA_JOB_LEASE = int(os.environ.get("MEDIA_JOB_LEASE", 60 * 60))
+MEDIA_JOB_ATTEMPTS = int(os.environ.get("MEDIA_JOB_ATTEMPTS", 3))
+MEDIA_POLL_INTERVAL = int(os.environ.get("MEDIA_POLL_INTERVAL", 30))
+# Heights of the lower-bitrate renditions, encoded only when smaller than the source.
+RENDITION_HEIGHTS = [int(height) for height in os.environ.get("MEDIA_RENDITIONS", "720,480,360").split(",")]
+RENDITION_CRF = int(os.environ.get("MEDIA_RENDITION_CRF", 26))
+# HLS: "auto" segments videos at least MEDIA_HLS_MIN_DURATION seconds long,
+# "always" segments every video and "off" disables it.
+MEDIA_HLS = os.environ.get("MEDIA_HLS", "auto")
+MEDIA_HLS_MIN_DURATION = int(os.environ.get("MEDIA_HLS_MIN_DURATION", 10 * 60))
+HLS_SEGMENT_SECONDS = int(os.environ.get("MEDIA_HLS_SEGMENT_SECONDS", 6))
+FFMPEG = os.environ.get("FFMPEG", "ffmpeg")
+FFPROBE = os.environ.get("FFPROBE", "ffprobe")
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+logger = logging.getLogger("training.media")
+
+job_available = asyncio.Event()
+workers = []
+
+
+class MediaError(Exception):
+    pass
+
+
+async def run_command(*args: str):
+    # ffmpeg runs in its own process, so encoding never blocks the event loop.
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise MediaError(f"{args[0]} exited with {process.returncode}: {stderr.decode(errors='replace')[-2000:]}")
+    return stdout
+
+
+def probed_number(value, kind):
+    # ffprobe reports "N/A" for values it can't determine, e.g. the bitrate of fragmented or streamed files.
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return kind(0)
+
+
+async def probe(path: str):
+    output = await run_command(FFPROBE, "-v", "error", "-select_streams", "v:0", "-show_entries", "format=duration,bit_rate:stream=width,height", "-of", "json", path)
+    info = json.loads(output)
+    stream = (info.get("streams") or [{}])[0]
+    return {
+        "duration": probed_number(info["format"].get("duration"), float),
+        "bitrate": probed_number(info["format"].get("bit_rate"), int),
+        "width": stream.get("width"),
+        "height": stream.get("height"),
+    }
+
+
+async def faststart(path: str):
+    # Move the moov atom to the front so playback can start before the whole
+    # file has downloaded. The remux replaces the original in place.
+    temp_path = f"{path}.faststart.part"
+    await run_command(FFMPEG, "-y", "-v", "error", "-i", path, "-c", "copy", "-movflags", "+faststart", "-f", "mp4", temp_path)
+    await run_in_threadpool(os.replace, temp_path, path)
+
+
+async def encode_rendition(path: str, height: int, destination: str):
+    temp_path = f"{destination}.part"
+    await run_command(FFMPEG, "-y", "-v", "error", "-i", path, "-vf", f"scale=-2:{height}", "-c:v", "libx264", "-preset", "veryfast", "-crf", str(RENDITION_CRF), "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart", "-f", "mp4", temp_path)
+    await run_in_threadpool(os.replace, temp_path, destination)
+    return {"height": height, "path": destination, "size": await run_in_threadpool(os.path.getsize, destination)}
+
+
+async def extract_poster(path: str, duration: float, destination: str):
+    offset = min(1.0, duration / 2) if duration else 0
+    await run_command(FFMPEG, "-y", "-v", "error", "-ss", str(offset), "-i", path, "-frames:v", "1", "-vf", "scale=640:-2", destination)
+    return destination
+
+
+def wants_hls(duration: float):
+    if MEDIA_HLS == "always":
+        return True
+    return MEDIA_HLS == "auto" and duration >= MEDIA_HLS_MIN_DURATION
+
+
+async def encode_hls_variant(path: str, height: int, output_dir: str, duration: float):
+    # Keyframes forced every HLS_SEGMENT_SECONDS of source time, whatever the
+    # frame rate, so every variant's segments start at the same boundaries and
+    # players can switch bitrate between them.
+    keyframes = f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})"
+    playlist = f"{height}p.m3u8"
+    await run_command(FFMPEG, "-y", "-v", "error", "-i", path, "-vf", f"scale=-2:{height}", "-c:v", "libx264", "-preset", "veryfast", "-crf", str(RENDITION_CRF), "-force_key_frames", keyframes, "-sc_threshold", "0", "-c:a", "aac", "-b:a", "96k", "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod", "-hls_segment_type", "mpegts", "-hls_segment_filename", os.path.join(output_dir, f"{height}p_%05d.ts"), os.path.join(output_dir, playlist))
+    size = await run_in_threadpool(lambda: sum(entry.stat().st_size for entry in os.scandir(output_dir) if entry.name.startswith(f"{height}p_")))
+    bandwidth = int(size * 8 / duration) if duration else 0
+    return {"height": height, "playlist": playlist, "bandwidth": bandwidth}
+
+
+def write_text(path: str, text: str):
+    with open(path, "w") as out:
+        out.write(text)
+
+
+async def segment_hls(mp4: str, info: dict):
+    # Each run writes to a fresh directory so every playlist and segment URL is
+    # immutable and can be cached forever by browsers, proxies and CDNs.
+    token = uuid.uuid4().hex
+    output_dir = os.path.join(os.path.dirname(mp4), "hls", token)
+    await run_in_threadpool(os.makedirs, output_dir, exist_ok=True)
+    heights = [height for height in sorted(RENDITION_HEIGHTS, reverse=True) if info["height"] and height < info["height"]]
+    if info["height"]:
+        heights.insert(0, info["height"])
+    variants = [await encode_hls_variant(mp4, height, output_dir, info["duration"]) for height in heights]
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for variant in variants:
+        width = round(info["width"] * variant["height"] / info["height"] / 2) * 2 if info["width"] and info["height"] else None
+        resolution = f",RESOLUTION={width}x{variant['height']}" if width else ""
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={variant['bandwidth']}{resolution}")
+        lines.append(variant["playlist"])
+    await run_in_threadpool(write_text, os.path.join(output_dir, "master.m3u8"), "\n".join(lines) + "\n")
+    # Earlier tokens stay until run_job has indexed this one; viewers may still be on them.
+    return {"token": token, "dir": output_dir, "playlist": "master.m3u8", "variants": variants}
+
+
+async def process_video(mp4: str):
+    # Returns the media metadata recorded on the video's catalog entry.
+    if shutil.which(FFMPEG) is None or shutil.which(FFPROBE) is None:
+        raise MediaError("ffmpeg/ffprobe not found; set FFMPEG and FFPROBE")
+    output_dir = os.path.join(os.path.dirname(mp4), "renditions")
+    await run_in_threadpool(os.makedirs, output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(mp4))[0]
+
+    info = await probe(mp4)
+    await faststart(mp4)
+    renditions = []
+    for height in sorted(RENDITION_HEIGHTS, reverse=True):
+        if info["height"] and height < info["height"]:
+            renditions.append(await encode_rendition(mp4, height, os.path.join(output_dir, f"{name}.{height}p.mp4")))
+    poster = await extract_poster(mp4, info["duration"], os.path.join(output_dir, "poster.jpg"))
+    hls = await segment_hls(mp4, info) if wants_hls(info["duration"]) else None
+    return {**info, "size": await run_in_threadpool(os.path.getsize, mp4), "faststart": True, "renditions": renditions, "poster": poster, "hls": hls, "processed_at": datetime.now()}
+
+
+async def enqueue(video_uuid: str):
+    job_id = str(uuid.uuid4())
+    await job_collection.insert_one({"job_id": job_id, "kind": "media", "status": "queued", "uuid": video_uuid, "attempts": 0, "created_at": datetime.now()})
+    job_available.set()
+    return job_id
+
+
+async def claim_job():
+    # Jobs live in Mongo, so a job whose worker died (restart, crash) is picked
+    # up again once its lease runs out.
+    now = datetime.now()
+    return await job_collection.find_one_and_update(
+        {"kind": "media", "attempts": {"$lt": MEDIA_JOB_ATTEMPTS}, "$or": [{"status": "queued"}, {"status": "running", "lease_until": {"$lt": now}}]},
+        {"$set": {"status": "running", "worker": WORKER_ID, "started_at": now, "lease_until": now + timedelta(seconds=MEDIA_JOB_LEASE)}, "$inc": {"attempts": 1}},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def run_job(job: dict):
+    from routers import vids
+
+    video = await vids.get_video_by_uuid(job["uuid"])
+    if video.mp4 is None:
+        raise MediaError(f"video {job['uuid']} is not in the catalog")
+    # With a remote storage backend this node may never have seen the upload.
+    await storage.backend.fetch(video.mp4)
+    previous_hls = (video.media or {}).get("hls")
+    video.media = await process_video(video.mp4)
+    # faststart rewrote the mp4 in place, so the upload's checksum no longer matches it.
+    video.sha256 = await run_in_threadpool(vids.hash_file, video.mp4)
+    await storage.backend.publish(os.path.dirname(video.mp4))
+    video.mtime = (await run_in_threadpool(os.stat, os.path.dirname(video.mp4))).st_mtime
+    await vids.index_video(video)
+    # Only once the catalog links the new token can the old segments go.
+    if previous_hls is not None and previous_hls["token"] != (video.media["hls"] or {}).get("token"):
+        await storage.backend.delete(previous_hls["dir"])
+
+
+async def worker():
+    while True:
+        try:
+            job = await claim_job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("could not claim a media job")
+            await asyncio.sleep(MEDIA_POLL_INTERVAL)
+            continue
+        if job is None:
+            job_available.clear()
+            try:
+                await asyncio.wait_for(job_available.wait(), MEDIA_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await run_job(job)
+            await job_collection.update_one({"job_id": job["job_id"]}, {"$set": {"status": "done", "finished_at": datetime.now()}})
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back so the next worker retries it.
+            await job_collection.update_one({"job_id": job["job_id"]}, {"$set": {"status": "queued"}, "$inc": {"attempts": -1}})
+            raise
+        except Exception as error:
+            logger.exception("media job %s for %s failed", job["job_id"], job["uuid"])
+            status = "failed" if job["attempts"] >= MEDIA_JOB_ATTEMPTS else "queued"
+            await job_collection.update_one({"job_id": job["job_id"]}, {"$set": {"status": status, "error": str(error), "finished_at": datetime.now()}})
+
+
+def start_workers():
+    for _ in range(MEDIA_WORKERS):
+        workers.append(asyncio.create_task(worker()))
+
+
+async def stop_workers():
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
@@ -0,0 +1,251 @@
+import bisect
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+# Set METRICS_TOKEN to require "Authorization: Bearer <token>" on /metrics.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Fraction of routine events (quiz submissions, ...) that are logged.
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.1))
+# Lets admins add ?profile=1 to a request to get a profile instead of the page.
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+def format_labels(labels: tuple, values: tuple):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{label}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for label, value in zip(labels, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *values, amount: float = 1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, total in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, values)} {total}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Label values -> [per-bucket counts (last is +Inf), sum, count]
+        self.values = {}
+
+    def observe(self, value: float, *values):
+        series = self.values.get(values)
+        if series is None:
+            series = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{format_labels(self.labels + ('le',), values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, values)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, values)} {count}"
+
+
+class Gauges:
+    # Point-in-time values read from a callback at scrape time, e.g. pool sizes.
+    def __init__(self, name: str, help: str, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for key, value in self.read().items():
+            if isinstance(value, (int, float)):
+                yield f'{self.name}{{key="{key}"}} {float(value)}'
+
+
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+request_duration = register(Histogram("http_request_duration_seconds", "Time to serve a request.", ("method", "route", "status")))
+response_bytes = register(Counter("http_response_bytes_total", "Response body bytes sent.", ("route",)))
+request_mongo_commands = register(Histogram("http_request_mongo_commands", "Mongo commands issued per request.", ("route",), COUNT_BUCKETS))
+request_mongo_duration = register(Histogram("http_request_mongo_seconds", "Time spent in Mongo commands per request.", ("route",)))
+mongo_command_duration = register(Histogram("mongo_command_duration_seconds", "Mongo command latency.", ("command",)))
+template_render_duration = register(Histogram("template_render_seconds", "Jinja render time.", ("template",)))
+video_lookup_duration = register(Histogram("video_lookup_seconds", "Time to resolve a video in get_video_by_uuid.", ("source",)))
+video_scan_duration = register(Histogram("video_scan_seconds", "Filesystem scan time while reindexing ./vids.", ("step",)))
+
+
+def render():
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+class RequestStats:
+    __slots__ = ("mongo_commands", "mongo_seconds")
+
+    def __init__(self):
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+
+
+# Motor runs commands on executor threads with a copy of the caller's context,
+# so the command listener still sees the request these stats belong to.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def record_mongo_command(command: str, seconds: float):
+    mongo_command_duration.observe(seconds, command)
+    stats = current_request.get()
+    if stats is not None:
+        stats.mongo_commands += 1
+        stats.mongo_seconds += seconds
+
+
+class timed:
+    # with timed(video_scan_duration, "scan"): ...
+    def __init__(self, histogram: Histogram, *values):
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.values)
+
+
+def instrument_templates(templates):
+    # Jinja2Templates renders inside TemplateResponse, so time it at the Template.
+    base = templates.env.template_class
+
+    class TimedTemplate(base):
+        def render(self, *args, **kwargs):
+            with timed(template_render_duration, self.name):
+                return super().render(*args, **kwargs)
+
+    templates.env.template_class = TimedTemplate
+
+
+def log_sampled(logger: logging.Logger, event: str, **fields):
+    # One JSON line per sampled event, so logs stay cheap and machine-readable.
+    if LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE:
+        logger.info(json.dumps({"event": event, "sample_rate": LOG_SAMPLE_RATE, **fields}, default=str))
+
+
+def route_name(scope):
+    # The route template keeps label cardinality bounded (/video/vids/{id}/{file}).
+    # Mounted apps (/assets, /public) only leave their mount point behind.
+    route = scope.get("route")
+    return getattr(route, "path", None) or scope.get("root_path") or "unmatched"
+
+
+async def is_admin_request(scope):
+    from dependencies import get_current_user, is_admin
+
+    cookies = SimpleCookie()
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            cookies.load(value.decode("latin-1"))
+    session = cookies.get("session")
+    user = await get_current_user(session.value if session else None)
+    return user is not None and is_admin(user)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if PROFILE_REQUESTS and parse_qs(scope.get("query_string", b"").decode()).get("profile") == ["1"] and await is_admin_request(scope):
+            return await self.profile(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+        sent = 0
+        started = time.perf_counter()
+
+        async def counting_send(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, counting_send)
+        finally:
+            current_request.reset(token)
+            route = route_name(scope)
+            request_duration.observe(time.perf_counter() - started, scope["method"], route, status)
+            response_bytes.inc(route, amount=sent)
+            request_mongo_commands.observe(stats.mongo_commands, route)
+            request_mongo_duration.observe(stats.mongo_seconds, route)
+
+    async def profile(self, scope, receive, send):
+        # The profiled response is thrown away and replaced by the report.
+        # cProfile sees every coroutine the loop runs meanwhile, so profile on a quiet worker.
+        async def discard(message):
+            pass
+
+        if pyinstrument is not None:
+            profiler = pyinstrument.Profiler(async_mode="enabled")
+            profiler.start()
+            try:
+                await self.app(scope, receive, discard)
+            finally:
+                profiler.stop()
+            body, media_type = profiler.output_html().encode(), b"text/html; charset=utf-8"
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, discard)
+            finally:
+                profiler.disable()
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(60)
+            body, media_type = report.getvalue().encode(), b"text/plain; charset=utf-8"
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", media_type), (b"content-length", str(len(body)).encode()), (b"cache-control", b"no-store")]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,60 @@
+import logging
+import re
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import completion_collection, user_collection
+
+
+logger = logging.getLogger("training.migrations")
+
+# content_completed entries used to be strings like "10/18/2026, 9:5, vid.mp4:  80.0%".
+COMPLETION_STRING = re.compile(r"^(\d+)/(\d+)/(\d+), (\d+):(\d+), (.*):  ([\d.]+)%$")
+
+
+def parse_completion_string(entry: str):
+    match = COMPLETION_STRING.match(entry)
+    if match is None:
+        return None
+    month, day, year, hour, minute, video, score = match.groups()
+    return {"video": video, "score": float(score), "completed_at": datetime(int(year), int(month), int(day), int(hour), int(minute))}
+
+
+async def migrate_completion_strings(video_uuids: dict = None):
+    # Move string completions into the completions collection and leave only
+    # video names in users' content_completed. Safe to run more than once, or
+    # from several workers at once: records are upserted on (user, video, time),
+    # which a unique index covers.
+    video_uuids = video_uuids or {}
+    migrated = 0
+    async for user in user_collection.find({"content_completed": {"$regex": "%$"}}, {"user_name": 1, "role": 1, "content_completed": 1}):
+        records = []
+        legacy = []
+        names = []
+        for entry in user["content_completed"]:
+            completion = parse_completion_string(entry)
+            if completion is None:
+                continue
+            legacy.append(entry)
+            key = {"user_name": user["user_name"], "video": completion["video"], "completed_at": completion["completed_at"], "migrated": True}
+            records.append(UpdateOne(key, {"$setOnInsert": {**key, "role": user.get("role"), "uuid": video_uuids.get(completion["video"]), "score": completion["score"]}}, upsert=True))
+            names.append(completion["video"])
+        if records:
+            try:
+                await completion_collection.bulk_write(records, ordered=False)
+            except BulkWriteError as error:
+                # Another worker inserted the same records first.
+                if any(write_error["code"] != 11000 for write_error in error.details["writeErrors"]):
+                    raise
+            migrated += len(records)
+        if legacy:
+            # Edit only the migrated entries, so a quiz completed on another
+            # worker meanwhile isn't overwritten. Mongo won't $pull and
+            # $addToSet the same field in one update.
+            await user_collection.update_one({"_id": user["_id"]}, {"$pull": {"content_completed": {"$in": legacy}}})
+            await user_collection.update_one({"_id": user["_id"]}, {"$addToSet": {"content_completed": {"$each": names}}})
+    if migrated:
+        logger.info("migrated %d completion strings", migrated)
+    return migrated
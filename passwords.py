@@ -0,0 +1,244 @@
+import asyncio
+import base64
+import hashlib
+import heapq
+import hmac
+import itertools
+import os
+import secrets
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+# scrypt cost. Raising any of these makes existing hashes get rehashed on their next login.
+PASSWORD_SCRYPT_N = int(os.environ.get("PASSWORD_SCRYPT_N", 2 ** 14))
+PASSWORD_SCRYPT_R = int(os.environ.get("PASSWORD_SCRYPT_R", 8))
+PASSWORD_SCRYPT_P = int(os.environ.get("PASSWORD_SCRYPT_P", 1))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# Hashes allowed to wait for a worker before new ones are turned away.
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", 64))
+LOGIN_WINDOW = int(os.environ.get("LOGIN_WINDOW", 15 * 60))
+LOGIN_MAX_FAILURES = int(os.environ.get("LOGIN_MAX_FAILURES", 5))
+# Counts failures only, so many users behind one NAT address can still log in.
+LOGIN_MAX_IP_FAILURES = int(os.environ.get("LOGIN_MAX_IP_FAILURES", 30))
+# Concurrent logins allowed from one address; extra ones are refused without waiting.
+LOGIN_MAX_IN_FLIGHT = int(os.environ.get("LOGIN_MAX_IN_FLIGHT", 16))
+# The lower cap for an address with LOGIN_MAX_FAILURES recent failures.
+LOGIN_MAX_IN_FLIGHT_FAILING = int(os.environ.get("LOGIN_MAX_IN_FLIGHT_FAILING", 2))
+LOGIN_THROTTLE_SIZE = int(os.environ.get("LOGIN_THROTTLE_SIZE", 100000))
+
+PREFIX = "$scrypt$"
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+class HashPool:
+    # hashlib.scrypt releases the GIL, so a few threads hash in parallel without
+    # blocking the event loop. Waiting hashes are ordered by priority (lower
+    # first, then arrival), so clients that have been hammering the login form
+    # queue behind everyone else and are the first to be shed when it's full.
+    def __init__(self, workers: int, queue_size: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.workers = workers
+        self.queue_size = queue_size
+        self.running = 0
+        self.waiting = []
+        self.order = itertools.count()
+        self.shed = 0
+
+    async def run(self, priority: int, function, *args):
+        if self.running < self.workers:
+            self.running += 1
+        else:
+            await self.wait_for_turn(priority)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.release()
+
+    async def wait_for_turn(self, priority: int):
+        turn = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.order), turn)
+        if len(self.waiting) >= self.queue_size:
+            worst = max(self.waiting, key=lambda waiting: waiting[:2])
+            self.shed += 1
+            if worst[:2] < entry[:2]:
+                raise HashPoolBusy()
+            self.waiting.remove(worst)
+            heapq.heapify(self.waiting)
+            worst[2].set_exception(HashPoolBusy())
+        heapq.heappush(self.waiting, entry)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled() and turn.exception() is None:
+                # The slot was already handed to us; pass it on.
+                self.release()
+            elif entry in self.waiting:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+            raise
+
+    def release(self):
+        # Hand the slot straight to the next waiter, if any.
+        while self.waiting:
+            turn = heapq.heappop(self.waiting)[2]
+            if not turn.done():
+                turn.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self):
+        return {"workers": self.workers, "running": self.running, "waiting": len(self.waiting), "shed": self.shed}
+
+
+hash_pool = HashPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE)
+
+
+def _b64(data: bytes):
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _unb64(data: str):
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20, dklen=KEY_BYTES)
+
+
+def hash_password_sync(password: str):
+    salt = secrets.token_bytes(SALT_BYTES)
+    key = _scrypt(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return f"{PREFIX}n={PASSWORD_SCRYPT_N},r={PASSWORD_SCRYPT_R},p={PASSWORD_SCRYPT_P}${_b64(salt)}${_b64(key)}"
+
+
+def is_hashed(stored: str):
+    return stored.startswith(PREFIX)
+
+
+def needs_rehash(stored: str):
+    # Plaintext records and hashes made with an older cost are upgraded on login.
+    return not is_hashed(stored) or not stored.startswith(f"{PREFIX}n={PASSWORD_SCRYPT_N},r={PASSWORD_SCRYPT_R},p={PASSWORD_SCRYPT_P}$")
+
+
+def verify_password_sync(password: str, stored: str | None):
+    if stored is None:
+        # Unknown users are checked against a dummy hash so the response time
+        # doesn't reveal which user names exist.
+        verify_password_sync(password, dummy_hash())
+        return False
+    if not is_hashed(stored):
+        # Records from before hashing was introduced.
+        return hmac.compare_digest(password.encode(), stored.encode())
+    params, salt, key = stored[len(PREFIX):].split("$")
+    cost = dict(param.split("=") for param in params.split(","))
+    expected = _unb64(key)
+    return hmac.compare_digest(_scrypt(password, _unb64(salt), int(cost["n"]), int(cost["r"]), int(cost["p"])), expected)
+
+
+async def hash_password(password: str, priority: int = 0):
+    return await hash_pool.run(priority, hash_password_sync, password)
+
+
+async def verify_password(password: str, stored: str | None, priority: int = 0):
+    return await hash_pool.run(priority, verify_password_sync, password, stored)
+
+
+_dummy_hash = None
+
+
+def dummy_hash():
+    global _dummy_hash
+    if _dummy_hash is None or needs_rehash(_dummy_hash):
+        _dummy_hash = hash_password_sync(secrets.token_hex(16))
+    return _dummy_hash
+
+
+class LoginThrottle:
+    # Sliding window of attempt times per key (a user name or client address),
+    # bounded like the session cache so a flood of keys can't grow it forever.
+    def __init__(self, limit: int, window: int, max_size: int):
+        self.limit = limit
+        self.window = window
+        self.max_size = max_size
+        self.attempts = OrderedDict()
+        self.rejected = 0
+
+    def _recent(self, key: str):
+        attempts = self.attempts.get(key)
+        if attempts is None:
+            return None
+        cutoff = time.monotonic() - self.window
+        while attempts and attempts[0] < cutoff:
+            attempts.popleft()
+        if not attempts:
+            del self.attempts[key]
+            return None
+        return attempts
+
+    def count(self, key: str):
+        attempts = self._recent(key)
+        return len(attempts) if attempts is not None else 0
+
+    def retry_after(self, key: str):
+        # Seconds until another attempt is allowed; 0 when not throttled.
+        attempts = self._recent(key)
+        if attempts is None or len(attempts) < self.limit:
+            return 0
+        self.rejected += 1
+        return int(attempts[0] + self.window - time.monotonic()) + 1
+
+    def record(self, key: str):
+        attempts = self._recent(key)
+        if attempts is None:
+            attempts = self.attempts[key] = deque(maxlen=self.limit)
+        attempts.append(time.monotonic())
+        self.attempts.move_to_end(key)
+        if len(self.attempts) > self.max_size:
+            self.attempts.popitem(last=False)
+
+    def reset(self, key: str):
+        self.attempts.pop(key, None)
+
+    def stats(self):
+        return {"tracked": len(self.attempts), "rejected": self.rejected}
+
+
+# Failed logins per user name and per client address.
+user_throttle = LoginThrottle(LOGIN_MAX_FAILURES, LOGIN_WINDOW, LOGIN_THROTTLE_SIZE)
+ip_throttle = LoginThrottle(LOGIN_MAX_IP_FAILURES, LOGIN_WINDOW, LOGIN_THROTTLE_SIZE)
+
+
+logins_in_flight = Counter()
+
+
+@contextmanager
+def login_in_flight(address: str):
+    logins_in_flight[address] += 1
+    try:
+        yield
+    finally:
+        logins_in_flight[address] -= 1
+        if not logins_in_flight[address]:
+            del logins_in_flight[address]
+
+
+def login_priority(address: str):
+    # Recent failures and concurrent logins from this address; guessing or a
+    # burst pushes its hashes behind clients logging in one at a time.
+    return ip_throttle.count(address) + logins_in_flight[address]
+
+
+def login_retry_after(user_name: str, address: str):
+    limit = LOGIN_MAX_IN_FLIGHT_FAILING if ip_throttle.count(address) >= LOGIN_MAX_FAILURES else LOGIN_MAX_IN_FLIGHT
+    if logins_in_flight[address] >= limit:
+        return 1
+    return max(user_throttle.retry_after(user_name), ip_throttle.retry_after(address))
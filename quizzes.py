@@ -6,55 +6,91 @@ from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 import motor.motor_asyncio
 
+from collections import OrderedDict
+
 class Question:
+    __slots__ = ("text", "options", "correct_answer")
+
     def __init__(self, text: str, options: list[str], correct_answer: str):
         self.text = text
         self.correct_answer = correct_answer
         self.options = options
+    def to_dict(self):
+        return {"text": self.text, "options": self.options, "correct_answer": self.correct_answer}
+    @classmethod
+    def from_dict(cls, question: dict):
+        return cls(question["text"], question["options"], question["correct_answer"])
+    def option_text(self, option: str):
+        return re.sub(r"^Option\d*:", "", option).strip()
     def check_answer(self, answer: str):
-        if answer == self.correct_answer and answer in self.options:
-            return True
-        else:
+        if answer is None or self.correct_answer is None:
             return False
+        return answer.strip() == self.correct_answer.strip()
 class Quiz:
     def __init__(self, questions: list[Question] = None, score = 0, file = None):
         self.questions = questions
         self.score = score
-    def score_quiz(self, answers: list[str]):
+    def grade(self, answers: dict[str, str]):
+        # Answers are keyed by question ("q0", "q1", ...), so each question is
+        # checked exactly once against the answer submitted for it.
+        results = []
         correct_count = 0
-        quiz_len = len(self.questions)
-
-        for question in self.questions:
-            #print(question.text)
-            for answer in answers:
-                if answer in question.correct_answer.replace("Answer: ", ""):
-                    # print("Correct!")
-                    correct_count +=1
-                else:
-                    continue
-        # print(correct_count)
-        # print(quiz_len)
-        score = (correct_count/quiz_len)*100
-        return score
+        for index, question in enumerate(self.questions):
+            answer = answers.get(f"q{index}")
+            correct = question.check_answer(answer)
+            correct_count += correct
+            results.append({"question": index, "answer": answer, "correct": correct})
+        score = (correct_count/len(self.questions))*100 if self.questions else 0
+        return {"score": score, "results": results}
+    def grade_many(self, submissions: list[dict[str, str]]):
+        return [self.grade(answers) for answers in submissions]
+    def to_dict(self):
+        return [question.to_dict() for question in self.questions]
+    @classmethod
+    def from_dict(cls, questions: list[dict]):
+        return cls([Question.from_dict(question) for question in questions])
     def from_file(self, file):
-        self.questions = []
         with open(file, "r") as quiz_file:
-            file_contents = quiz_file.read().splitlines()
-            # file_split = re.split("\n", file_contents)
-            # file_string = ''.join(file_split)
-
-            question = Question(None, [], None)
-            for line in file_contents:
-                if line != None or [] or "None":
-                    question_search = re.search(r"Question:", line)
-                    answer_search = re.search(r"Answer:", line)
-                    option_search = re.search(r"Option:*", line)
-
-                    if question_search:
-                        question.text = question_search.string.replace("Question:", "").replace("\n", "")
-                    if option_search:
-                        question.options.append(option_search.string.replace("\n", ""))
-                    if answer_search:
-                        question.correct_answer = answer_search.string.replace("Answer:", "").replace("\n", "")
-                        self.questions.append(question)
-                        question = Question(None, [], None)
+            self.from_text(quiz_file.read())
+    def from_text(self, text: str):
+        self.questions = []
+        file_contents = text.splitlines()
+
+        question = Question(None, [], None)
+        for line in file_contents:
+            if line != None or [] or "None":
+                question_search = re.search(r"Question:", line)
+                answer_search = re.search(r"Answer:", line)
+                option_search = re.search(r"Option:*", line)
+
+                if question_search:
+                    question.text = question_search.string.replace("Question:", "").replace("\n", "")
+                if option_search:
+                    question.options.append(option_search.string.replace("\n", ""))
+                if answer_search:
+                    question.correct_answer = answer_search.string.replace("Answer:", "").replace("\n", "")
+                    self.questions.append(question)
+                    question = Question(None, [], None)
+
+
+
+# Parsed quizzes keyed by (video uuid, quiz file mtime) so a replaced quiz file
+# never hits a stale entry.
+QUIZ_CACHE_SIZE = 256
+quiz_cache: OrderedDict = OrderedDict()
+
+def get_cached_quiz(uuid: str, mtime: float, load):
+    key = (uuid, mtime)
+    quiz = quiz_cache.get(key)
+    if quiz is not None:
+        quiz_cache.move_to_end(key)
+        return quiz
+    quiz = load()
+    quiz_cache[key] = quiz
+    if len(quiz_cache) > QUIZ_CACHE_SIZE:
+        quiz_cache.popitem(last=False)
+    return quiz
+
+def invalidate_quiz(uuid: str):
+    for key in [key for key in quiz_cache if key[0] == uuid]:
+        del quiz_cache[key]
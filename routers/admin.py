@@ -1,68 +1,191 @@
+import base64
 import os
+import re
+from datetime import datetime
 from typing import Annotated
-from fastapi import APIRouter, Cookie, HTTPException, Request
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
-import motor.motor_asyncio
+from urllib.parse import urlencode
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
 
+import database
+import events
+import passwords
+from bson import ObjectId
+from database import completion_collection, user_collection
+from dependencies import require_admin, session_cache
+from templating import templates
 from .vids import get_videos
 
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
-client = motor.motor_asyncio.AsyncIOMotorClient("127.0.0.1:27017")
-db = client.train
+PAGE_SIZE = 50
+# The dashboard only shows a user's most recent completions.
+COMPLETED_PREVIEW = 5
+USER_SORTS = ("user_name", "name", "role", "email")
+USER_TABLE_PROJECTION = {"_id": 0, "name": 1, "role": 1, "user_name": 1, "email": 1, "content_assigned": 1, "content_completed": {"$slice": -COMPLETED_PREVIEW}}
+LOGS_PROJECTION = {"user_name": 1, "role": 1, "video": 1, "uuid": 1, "score": 1, "completed_at": 1}
 
-user_collection = db.get_collection("users")
-vid_collection = db.get_collection("vids")
+
+def encode_cursor(value, user_name: str):
+    return base64.urlsafe_b64encode(f"{value or ''}\x1f{user_name}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        value, user_name = base64.urlsafe_b64decode(cursor.encode()).decode().split("\x1f", 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return value, user_name
+
+
+async def get_users_page(projection: dict, query: dict = None, cursor: str = None, sort: str = "user_name", page_size: int = PAGE_SIZE):
+    # Keyset pagination: each page starts after the (sort value, user_name) of
+    # the last row of the previous one, so deep pages cost the same as the first.
+    if sort not in USER_SORTS:
+        sort = "user_name"
+    query = dict(query or {})
+    if cursor:
+        value, user_name = decode_cursor(cursor)
+        if sort == "user_name":
+            after = {"user_name": {"$gt": user_name}}
+        else:
+            after = {"$or": [{sort: {"$gt": value}}, {sort: value, "user_name": {"$gt": user_name}}]}
+        query = {"$and": [query, after]} if query else after
+    users = await user_collection.find(query, projection).sort([(sort, 1), ("user_name", 1)]).limit(page_size + 1).to_list(page_size + 1)
+    next_cursor = None
+    if len(users) > page_size:
+        users = users[:page_size]
+        next_cursor = encode_cursor(users[-1].get(sort), users[-1]["user_name"])
+    return users, next_cursor
+
+
+def user_filter(q: str = None, role: str = None):
+    query = {}
+    if q:
+        query["$or"] = [{"user_name": {"$regex": f"^{re.escape(q)}"}}, {"name": {"$regex": re.escape(q), "$options": "i"}}]
+    if role:
+        query["role"] = role
+    return query
+
+
+def completion_filter(q: str = None, role: str = None, video: str = None):
+    query = {}
+    if q:
+        query["user_name"] = {"$regex": f"^{re.escape(q)}"}
+    if role:
+        query["role"] = role
+    if video:
+        query["video"] = video
+    return query
+
+
+async def get_completions_page(query: dict, cursor: str = None, page_size: int = PAGE_SIZE):
+    # Newest first, paged on (completed_at, _id).
+    query = dict(query)
+    if cursor:
+        value, id = decode_cursor(cursor)
+        try:
+            completed_at, id = datetime.fromisoformat(value), ObjectId(id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+        query["$or"] = [{"completed_at": {"$lt": completed_at}}, {"completed_at": completed_at, "_id": {"$lt": id}}]
+    completions = await completion_collection.find(query, LOGS_PROJECTION).sort([("completed_at", -1), ("_id", -1)]).limit(page_size + 1).to_list(page_size + 1)
+    next_cursor = None
+    if len(completions) > page_size:
+        completions = completions[:page_size]
+        next_cursor = encode_cursor(completions[-1]["completed_at"].isoformat(), str(completions[-1]["_id"]))
+    return completions, next_cursor
+
+
+def next_page_url(path: str, next_cursor: str, **params):
+    if next_cursor is None:
+        return None
+    params = {key: value for key, value in params.items() if value}
+    return f"{path}?{urlencode({**params, 'cursor': next_cursor})}"
 
 
 # Admin Dashboard
 @router.get("/v/administration", response_description="Get the admin view.", response_class=HTMLResponse)
-async def get_admin_view(request: Request, user: Annotated[str | None, Cookie()] = None):
-    user = await user_collection.find_one({'user_name': user})
-    if user:
-        if user["admin"] == True or "True":
-            content = await get_videos()
-            videos = []
-            for vid in content:
-                videos.append(os.path.basename(vid))
-            users =  await user_collection.find().to_list(1000)
-            context = {"request": request, "users": users, "vids": videos}
-            return templates.TemplateResponse("admin.html", context)
-        else:
-            return HTTPException(status_code=401)
+async def get_admin_view(request: Request, user: Annotated[dict, Depends(require_admin)], q: str = None, role: str = None, sort: str = "user_name"):
+    content = await get_videos()
+    videos = []
+    for vid in content:
+        videos.append(os.path.basename(vid))
+    users, next_cursor = await get_users_page(USER_TABLE_PROJECTION, user_filter(q, role), sort=sort)
+    context = {"request": request, "users": users, "vids": videos, "next_page": next_page_url("/v/users", next_cursor, q=q, role=role, sort=sort), "q": q, "role": role, "sort": sort}
+    return templates.TemplateResponse(request, "admin.html", context)
+
+
+@router.get("/v/users", response_description="Get a page of rows for the users table.", response_class=HTMLResponse)
+async def get_users_rows(request: Request, user: Annotated[dict, Depends(require_admin)], q: str = None, role: str = None, sort: str = "user_name", cursor: str = None):
+    users, next_cursor = await get_users_page(USER_TABLE_PROJECTION, user_filter(q, role), cursor, sort)
+    context = {"request": request, "users": users, "next_page": next_page_url("/v/users", next_cursor, q=q, role=role, sort=sort)}
+    return templates.TemplateResponse(request, "users_table.html", context)
+
+
+@router.get("/v/administration/sessions", response_description="Session cache statistics.")
+async def get_session_stats(user: Annotated[dict, Depends(require_admin)]):
+    return session_cache.stats()
+
+
+@router.get("/v/administration/logins", response_description="Login throttling and password hashing statistics.")
+async def get_login_stats(user: Annotated[dict, Depends(require_admin)]):
+    return {"users": passwords.user_throttle.stats(), "addresses": passwords.ip_throttle.stats(), "hash_pool": passwords.hash_pool.stats()}
+
+
+@router.get("/v/administration/database", response_description="Mongo connection pool and query statistics.")
+async def get_database_stats(user: Annotated[dict, Depends(require_admin)]):
+    return database.stats()
+
+
+@router.get("/v/administration/events", response_description="Live dashboard updates as server-sent events.")
+async def get_admin_events(user: Annotated[dict, Depends(require_admin)]):
+    headers = {"cache-control": "no-cache", "x-accel-buffering": "no"}
+    return StreamingResponse(events.broker.stream(), media_type="text/event-stream", headers=headers)
+
+
+@events.renderer("user")
+async def publish_user_rows(user_names: list[str]):
+    user_names = set(user_names)
+    if len(user_names) > PAGE_SIZE:
+        # A bulk assignment; refetching the page each dashboard shows is cheaper.
+        events.broker.publish("reload", "")
+        return
+    template = templates.get_template("user_row.html")
+    async for user in user_collection.find({"user_name": {"$in": list(user_names)}}, USER_TABLE_PROJECTION):
+        user_names.discard(user["user_name"])
+        events.broker.publish(f"user-{user['user_name']}", template.render(user=user))
+    # Deleted users: an empty swap removes their row.
+    for user_name in user_names:
+        events.broker.publish(f"user-{user_name}", "")
+
+
+@events.renderer("completion")
+async def publish_completion_rows(completions: list[dict]):
+    template = templates.get_template("completion_row.html")
+    for completion in completions:
+        events.broker.publish("completion", template.render(completion=completion))
 
 
 # User Management
 
 @router.get("/v/create_user", response_description="View for creating a user.", response_class=HTMLResponse)
-async def create_user_view(request: Request, user: Annotated[str | None, Cookie()] = None):
-    user = await user_collection.find_one({'user_name': user})
-    if user["admin"] == True:
-        context = {"request": request}
-        return templates.TemplateResponse("add_user.html", context)
-    else:
-        return HTTPException(status_code=401)
+async def create_user_view(request: Request, user: Annotated[dict, Depends(require_admin)]):
+    context = {"request": request}
+    return templates.TemplateResponse(request, "add_user.html", context)
 
 @router.get("/v/user/{id}", response_description="Get a single user.", response_class=HTMLResponse)
-async def user_view(request: Request, id: str, user: Annotated[str | None, Cookie()] = None):
-    # Check for the admin cookie if it exists view the user.
-    viewing_user_account = await user_collection.find_one({"user_name": user})
-    if viewing_user_account["admin"] == True or "True":
-        user = await user_collection.find_one({"user_name": id})
-        context = {"request": request, "user": user}
-        if user is not None:
-            return templates.TemplateResponse("user.html", context)
-        else:
-            raise HTTPException(status_code=404, detail=f"User {id} not found.")
+async def user_view(request: Request, id: str, viewing_user: Annotated[dict, Depends(require_admin)]):
+    user = await user_collection.find_one({"user_name": id})
+    context = {"request": request, "user": user}
+    if user is not None:
+        return templates.TemplateResponse(request, "user.html", context)
     else:
-        return HTTPException(status_code=401)
+        raise HTTPException(status_code=404, detail=f"User {id} not found.")
 
 @router.get("/v/user/{id}/ac", response_description="Assign content to a user.", response_class=HTMLResponse)
-async def assign_content_view(request: Request, id:str, viewing_user: Annotated[str | None, Cookie()] = None):
-    # Check for the admin cookie if it exists view the assigning content.
+async def assign_content_view(request: Request, id:str, viewing_user: Annotated[dict, Depends(require_admin)]):
     user = await user_collection.find_one({"user_name": id})
     content = await get_videos()
     videos = []
@@ -71,19 +194,26 @@ async def assign_content_view(request: Request, id:str, viewing_user: Annotated[
     
     context = {"request": request, "user": user, "vids": videos}
     if user is not None:
-        return templates.TemplateResponse("assign_content.html", context)
+        return templates.TemplateResponse(request, "assign_content.html", context)
     else:
         raise HTTPException(status_code=404, detail=f"User {id} not found.")
 
 # Video Management
 @router.get("/v/upload_video", response_description="Upload video view", response_class=HTMLResponse)
-async def upload_video_view(request: Request):
+async def upload_video_view(request: Request, user: Annotated[dict, Depends(require_admin)]):
     context = {"request": request}
-    return templates.TemplateResponse("upload_video.html", context)
+    return templates.TemplateResponse(request, "upload_video.html", context)
 
 # Logging
 @router.get("/v/logs", response_description="Get the logs of completed content", response_class=HTMLResponse)
-async def get_logs_view(request: Request):
-    users = await user_collection.find().to_list(1000)
-    context = {"request": request, "users": users}
-    return templates.TemplateResponse("logs.html", context)
\ No newline at end of file
+async def get_logs_view(request: Request, user: Annotated[dict, Depends(require_admin)], q: str = None, role: str = None, video: str = None):
+    completions, next_cursor = await get_completions_page(completion_filter(q, role, video))
+    context = {"request": request, "completions": completions, "next_page": next_page_url("/v/logs/rows", next_cursor, q=q, role=role, video=video), "q": q, "role": role, "video": video}
+    return templates.TemplateResponse(request, "logs.html", context)
+
+
+@router.get("/v/logs/rows", response_description="Get a page of the completed content logs", response_class=HTMLResponse)
+async def get_logs_rows(request: Request, user: Annotated[dict, Depends(require_admin)], q: str = None, role: str = None, video: str = None, cursor: str = None):
+    completions, next_cursor = await get_completions_page(completion_filter(q, role, video), cursor)
+    context = {"request": request, "completions": completions, "next_page": next_page_url("/v/logs/rows", next_cursor, q=q, role=role, video=video)}
+    return templates.TemplateResponse(request, "logs_table.html", context)
\ No newline at end of file
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from typing import Annotated, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from pymongo import UpdateMany
+
+import events
+from database import group_collection, job_collection, user_collection
+from dependencies import require_admin, session_cache
+from templating import invalidate_user
+
+
+router = APIRouter()
+logger = logging.getLogger("training.assignments")
+
+# Batches that target more users than this run as a background job.
+BULK_ASSIGN_SYNC_LIMIT = 1000
+
+# Keep references to running jobs so they aren't garbage collected.
+running_jobs = set()
+
+
+class BulkAssignmentModel(BaseModel):
+    videos: List[str]
+    user_names: Optional[List[str]] = None
+    role: Optional[str] = None
+    group: Optional[str] = None
+
+
+class GroupModel(BaseModel):
+    name: str
+    user_names: List[str]
+
+
+async def resolve_target(assignment: BulkAssignmentModel):
+    if assignment.user_names is not None:
+        return {"user_name": {"$in": assignment.user_names}}
+    if assignment.role is not None:
+        return {"role": assignment.role}
+    if assignment.group is not None:
+        group = await group_collection.find_one({"name": assignment.group})
+        if group is None:
+            raise HTTPException(status_code=404, detail=f"Group {assignment.group} not found.")
+        return {"user_name": {"$in": group["user_names"]}}
+    raise HTTPException(status_code=400, detail="Give user_names, role or group to assign to.")
+
+
+async def assign_videos(target: dict, videos: list[str], per_user: bool = True):
+    # One read to work out per-user results, then one bulk_write with an
+    # update_many per video. The write filters skip users that already have
+    # the video assigned or completed, so the read is only used for reporting.
+    results = {}
+    counts = {"assigned": 0, "already_assigned": 0, "completed": 0}
+    user_names = []
+    async for user in user_collection.find(target, {"_id": 0, "user_name": 1, "content_assigned": 1, "content_completed": 1}):
+        assigned = set(user.get("content_assigned") or [])
+        completed = set(user.get("content_completed") or [])
+        user_results = {}
+        for video in videos:
+            if video in completed:
+                user_results[video] = "completed"
+            elif video in assigned:
+                user_results[video] = "already_assigned"
+            else:
+                user_results[video] = "assigned"
+            counts[user_results[video]] += 1
+        if per_user:
+            results[user["user_name"]] = user_results
+        user_names.append(user["user_name"])
+
+    now = datetime.now()
+    operations = [UpdateMany(
+        {**target, "content_assigned": {"$ne": video}, "content_completed": {"$ne": video}},
+        {"$addToSet": {"content_assigned": video}, "$push": {"assignments": {"video": video, "assigned_at": now}}},
+    ) for video in videos]
+    write_result = await user_collection.bulk_write(operations, ordered=False)
+    # Invalidated only now: a request between the read and the write would
+    # otherwise re-cache the user without the new assignments.
+    for user_name in user_names:
+        session_cache.invalidate(user_name)
+        invalidate_user(user_name)
+        events.emit("user", user_name)
+    return {"modified": write_result.modified_count, "counts": counts, "results": results}
+
+
+async def run_assignment_job(job_id: str, target: dict, videos: list[str]):
+    await job_collection.update_one({"job_id": job_id}, {"$set": {"status": "running", "started_at": datetime.now()}})
+    try:
+        # Per-user results for very large batches would not fit in the job document.
+        result = await assign_videos(target, videos, per_user=False)
+        await job_collection.update_one({"job_id": job_id}, {"$set": {"status": "done", "finished_at": datetime.now(), "modified": result["modified"], "counts": result["counts"]}})
+    except Exception as error:
+        logger.exception("bulk assignment job %s failed", job_id)
+        await job_collection.update_one({"job_id": job_id}, {"$set": {"status": "failed", "finished_at": datetime.now(), "error": str(error)}})
+
+
+@router.post("/assignments/bulk", response_description="Assign videos to many users at once.")
+async def bulk_assign(assignment: BulkAssignmentModel, user: Annotated[dict, Depends(require_admin)]):
+    if not assignment.videos:
+        raise HTTPException(status_code=400, detail="No videos to assign.")
+    target = await resolve_target(assignment)
+    if await user_collection.count_documents(target) > BULK_ASSIGN_SYNC_LIMIT:
+        job_id = str(uuid.uuid4())
+        await job_collection.insert_one({"job_id": job_id, "kind": "bulk_assign", "status": "queued", "created_at": datetime.now(), "videos": assignment.videos, "target": assignment.model_dump(exclude={"videos"})})
+        task = asyncio.create_task(run_assignment_job(job_id, target, assignment.videos))
+        running_jobs.add(task)
+        task.add_done_callback(running_jobs.discard)
+        return JSONResponse({"job_id": job_id, "status": "queued"}, status_code=status.HTTP_202_ACCEPTED)
+    return await assign_videos(target, assignment.videos)
+
+
+@router.get("/assignments/jobs/{job_id}", response_description="Get the status of a bulk assignment job.")
+async def get_assignment_job(job_id: str, user: Annotated[dict, Depends(require_admin)]):
+    job = await job_collection.find_one({"job_id": job_id, "kind": "bulk_assign"}, {"_id": 0})
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
+
+
+# Saved groups of users to assign content to.
+@router.post("/groups", response_description="Create or replace a group of users.")
+async def save_group(group: GroupModel, user: Annotated[dict, Depends(require_admin)]):
+    await group_collection.update_one({"name": group.name}, {"$set": group.model_dump()}, upsert=True)
+    return group
+
+
+@router.get("/groups", response_description="List groups.")
+async def get_groups(user: Annotated[dict, Depends(require_admin)]):
+    return await group_collection.find({}, {"_id": 0}).to_list(1000)
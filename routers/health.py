@@ -0,0 +1,37 @@
+import asyncio
+import os
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+import database
+import lifecycle
+import storage
+
+
+router = APIRouter()
+
+# Each readiness check gets this long before the node is reported not ready.
+READY_CHECK_TIMEOUT = float(os.environ.get("READY_CHECK_TIMEOUT", 2))
+
+
+async def check(probe):
+    try:
+        await asyncio.wait_for(probe(), READY_CHECK_TIMEOUT)
+    except Exception as error:
+        return f"{type(error).__name__}: {error}"
+    return "ok"
+
+
+@router.get("/healthz", response_description="Liveness: the process is up and serving requests.")
+async def healthz():
+    return {"status": "ok"}
+
+
+@router.get("/readyz", response_description="Readiness: whether this node should be sent traffic.")
+async def readyz():
+    if not lifecycle.ready:
+        return JSONResponse({"status": "draining" if lifecycle.draining else "starting"}, status_code=503)
+    checks = {"mongo": await check(lambda: database.client.admin.command("ping")), "storage": await check(storage.backend.check)}
+    ok = all(result == "ok" for result in checks.values())
+    return JSONResponse({"status": "ok" if ok else "unavailable", "checks": checks}, status_code=200 if ok else 503)
@@ -0,0 +1,24 @@
+import os
+import re
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse
+
+from routers.vids import file_response, get_video_by_uuid
+
+
+router = APIRouter()
+
+HLS_MEDIA_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+# Everything under a token directory is written once and never changes.
+HLS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@router.get("/hls/{id}/{token}/{file}", response_description="Get an HLS playlist or segment.", response_class=FileResponse)
+async def get_hls_file(request: Request, id: str, token: str, file: str):
+    video = await get_video_by_uuid(id)
+    hls = (video.media or {}).get("hls")
+    extension = os.path.splitext(file)[1]
+    if hls is None or token != hls["token"] or extension not in HLS_MEDIA_TYPES or not re.fullmatch(r"[\w.-]+", file):
+        raise HTTPException(status_code=404, detail=f"{file} not found.")
+    return await file_response(request, os.path.join(hls["dir"], file), HLS_MEDIA_TYPES[extension], HLS_CACHE_CONTROL)
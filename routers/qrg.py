@@ -1,15 +1,161 @@
+import hashlib
+import json
 import os
+import re
+from email.utils import formatdate
 from typing import Annotated
-from fastapi import APIRouter, Cookie, HTTPException, Request, Response
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
 
-from fastapi.templating import Jinja2Templates
-import motor.motor_asyncio
+import assets
+from dependencies import require_admin
+from templating import templates
+from .vids import is_not_modified
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
-@router.get("/qrg/change_miner_fan", response_description="Changing Miner Fan QRG", response_class=HTMLResponse)
-async def get_change_miner_fan_qrg(request: Request, response: Response):
-    context = {"request": request}
-    return templates.TemplateResponse("qrgs/changing_miner_fan.html", context)
\ No newline at end of file
+# One directory per guide: public/QRG/<slug>/manifest.json plus its figures.
+QRG_DIR = os.path.join(assets.PUBLIC_DIR, "QRG")
+MANIFEST = "manifest.json"
+SNIPPET_LENGTH = 160
+SEARCH_LIMIT = 50
+
+WORD = re.compile(r"\w+")
+SLUG = re.compile(r"[\w-]+")
+
+
+class Guide:
+    __slots__ = ("slug", "mtime", "data", "html", "etag", "last_modified")
+
+    def __init__(self, slug: str, mtime: float, data: dict):
+        self.slug = slug
+        self.mtime = mtime
+        self.data = data
+        # Guides are static, so each one is rendered once per manifest change.
+        self.html = templates.get_template("qrg.html").render(guide={**data, "slug": slug}).encode()
+        self.etag = f'"{hashlib.sha256(self.html).hexdigest()[:32]}"'
+        self.last_modified = formatdate(mtime, usegmt=True)
+
+
+guides = {}
+# Search index: word -> set of (slug, section number); section 0 is the guide itself.
+search_index = {}
+search_text = {}
+
+
+def manifest_path(slug: str):
+    return os.path.join(QRG_DIR, slug, MANIFEST)
+
+
+def load_guide(slug: str):
+    path = manifest_path(slug)
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding="utf-8") as manifest_file:
+        return Guide(slug, mtime, json.load(manifest_file))
+
+
+def guide_entries(guide: Guide):
+    data = guide.data
+    yield 0, data["title"], " ".join([data["title"], data.get("subtitle", ""), " ".join(data.get("tags", []))])
+    for number, section in enumerate(data.get("sections", []), 1):
+        parts = [section["title"]]
+        for step in section.get("steps", []):
+            parts.append(step.get("text", ""))
+            parts.append(step.get("note", ""))
+            parts.extend(figure.get("caption", "") for figure in step.get("figures", []))
+        yield number, f"{data['title']} – {section['title']}", " ".join(part for part in parts if part)
+
+
+def build_search_index():
+    search_index.clear()
+    search_text.clear()
+    for guide in guides.values():
+        for number, title, text in guide_entries(guide):
+            search_text[(guide.slug, number)] = (title, text)
+            for word in set(WORD.findall(text.lower())):
+                search_index.setdefault(word, set()).add((guide.slug, number))
+
+
+def discover_guides():
+    # Loads new and changed guides and drops removed ones; unchanged guides keep
+    # their rendered page.
+    found = set()
+    if os.path.isdir(QRG_DIR):
+        for entry in os.scandir(QRG_DIR):
+            if not entry.is_dir() or not os.path.isfile(manifest_path(entry.name)):
+                continue
+            found.add(entry.name)
+            guide = guides.get(entry.name)
+            if guide is None or guide.mtime != os.stat(manifest_path(entry.name)).st_mtime:
+                guides[entry.name] = load_guide(entry.name)
+    for slug in set(guides) - found:
+        del guides[slug]
+    build_search_index()
+    return guides
+
+
+def snippet(text: str, words: list[str]):
+    lowered = text.lower()
+    start = min((lowered.find(word) for word in words if word in lowered), default=0)
+    start = max(0, start - SNIPPET_LENGTH // 4)
+    end = start + SNIPPET_LENGTH
+    return ("…" if start else "") + text[start:end].strip() + ("…" if end < len(text) else "")
+
+
+def search_guides(q: str):
+    words = WORD.findall(q.lower())
+    if not words:
+        return [{"slug": slug, "section": None, "title": guide.data["title"], "snippet": guide.data.get("subtitle")} for slug, guide in sorted(guides.items(), key=lambda item: item[1].data["title"])]
+    matches = None
+    for word in words:
+        # Prefix match so results update while a word is still being typed.
+        hits = set().union(*[entries for indexed, entries in search_index.items() if indexed.startswith(word)])
+        matches = hits if matches is None else matches & hits
+    results = []
+    for slug, number in sorted(matches, key=lambda match: (match[1] != 0, match)):
+        title, text = search_text[(slug, number)]
+        results.append({"slug": slug, "section": number or None, "title": title, "snippet": snippet(text, words)})
+    return results[:SEARCH_LIMIT]
+
+
+async def get_guide(slug: str):
+    # One stat per request picks up manifest edits without a restart.
+    if not SLUG.fullmatch(slug):
+        raise HTTPException(status_code=404, detail=f"Guide {slug} not found.")
+    try:
+        mtime = os.stat(manifest_path(slug)).st_mtime
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail=f"Guide {slug} not found.")
+    guide = guides.get(slug)
+    if guide is None or guide.mtime != mtime:
+        guide = await run_in_threadpool(load_guide, slug)
+        guides[slug] = guide
+        build_search_index()
+    return guide
+
+
+@router.get("/qrg", response_description="Search quick reference guides", response_class=HTMLResponse)
+async def list_qrgs(request: Request, q: str = ""):
+    context = {"request": request, "q": q, "results": search_guides(q)}
+    return templates.TemplateResponse(request, "qrgs.html", context)
+
+
+@router.get("/qrg/search", response_description="Search quick reference guides")
+async def search_qrgs(q: str = ""):
+    return search_guides(q)
+
+
+@router.post("/qrg/reindex", response_description="Rescan the guide directory")
+async def reindex_qrgs(user: Annotated[dict, Depends(require_admin)]):
+    await run_in_threadpool(discover_guides)
+    return {"guides": sorted(guides)}
+
+
+@router.get("/qrg/{slug}", response_description="Quick reference guide", response_class=HTMLResponse)
+async def get_qrg(request: Request, slug: str):
+    guide = await get_guide(slug)
+    headers = {"etag": guide.etag, "last-modified": guide.last_modified, "cache-control": "no-cache"}
+    if is_not_modified(headers, request.headers):
+        return Response(status_code=304, headers=headers)
+    return Response(guide.html, media_type="text/html; charset=utf-8", headers=headers)
@@ -0,0 +1,245 @@
+import csv
+import io
+import json
+import zipfile
+import zlib
+from datetime import datetime, timedelta
+from typing import Annotated
+from xml.sax.saxutils import escape
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from database import completion_collection, user_collection
+from dependencies import require_admin
+
+
+router = APIRouter()
+
+
+def report_response(rows: list[dict], fields: list[str], format: str, name: str):
+    if format == "csv":
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+        return Response(out.getvalue(), media_type="text/csv", headers={"Content-Disposition": f'attachment; filename="{name}.csv"'})
+    return JSONResponse([{field: row.get(field) for field in fields} for row in rows])
+
+
+def jsonable(row: dict):
+    return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in row.items()}
+
+
+# Completion rate and average score per video.
+@router.get("/reports/videos", response_description="Completion rate and average score per video.")
+async def get_video_report(user: Annotated[dict, Depends(require_admin)], format: str = "json"):
+    completed = completion_collection.aggregate([
+        # One row per (video, user) first so repeat attempts don't count as extra users.
+        {"$group": {"_id": {"video": "$video", "user_name": "$user_name"}, "attempts": {"$sum": 1}, "score_total": {"$sum": "$score"}}},
+        {"$group": {"_id": "$_id.video", "users_completed": {"$sum": 1}, "completions": {"$sum": "$attempts"}, "score_total": {"$sum": "$score_total"}}},
+    ], allowDiskUse=True)
+    outstanding = user_collection.aggregate([
+        {"$unwind": "$content_assigned"},
+        {"$group": {"_id": "$content_assigned", "outstanding": {"$sum": 1}}},
+    ], allowDiskUse=True)
+
+    videos = {}
+    async for row in completed:
+        videos[row["_id"]] = {"video": row["_id"], "users_completed": row["users_completed"], "completions": row["completions"], "average_score": round(row["score_total"] / row["completions"], 2), "outstanding": 0}
+    async for row in outstanding:
+        videos.setdefault(row["_id"], {"video": row["_id"], "users_completed": 0, "completions": 0, "average_score": None})["outstanding"] = row["outstanding"]
+    for video in videos.values():
+        assigned = video["users_completed"] + video["outstanding"]
+        video["completion_rate"] = round(video["users_completed"] / assigned, 4) if assigned else None
+
+    rows = sorted(videos.values(), key=lambda video: video["video"])
+    return report_response(rows, ["video", "users_completed", "completions", "average_score", "outstanding", "completion_rate"], format, "videos")
+
+
+# Per-role compliance: a user is compliant when nothing assigned is outstanding.
+@router.get("/reports/roles", response_description="Training compliance per role.")
+async def get_role_report(user: Annotated[dict, Depends(require_admin)], format: str = "json"):
+    rows = []
+    async for row in user_collection.aggregate([
+        {"$project": {"role": 1, "outstanding": {"$size": {"$ifNull": ["$content_assigned", []]}}, "completed": {"$size": {"$ifNull": ["$content_completed", []]}}}},
+        {"$group": {"_id": "$role", "users": {"$sum": 1}, "outstanding": {"$sum": "$outstanding"}, "completed": {"$sum": "$completed"}, "compliant_users": {"$sum": {"$cond": [{"$eq": ["$outstanding", 0]}, 1, 0]}}}},
+        {"$sort": {"_id": 1}},
+    ], allowDiskUse=True):
+        rows.append({"role": row["_id"], "users": row["users"], "compliant_users": row["compliant_users"], "compliance": round(row["compliant_users"] / row["users"], 4), "outstanding": row["outstanding"], "completed": row["completed"]})
+    return report_response(rows, ["role", "users", "compliant_users", "compliance", "outstanding", "completed"], format, "roles")
+
+
+# Assignments still outstanding after `days` days.
+@router.get("/reports/overdue", response_description="Assignments outstanding for longer than the given number of days.")
+async def get_overdue_report(user: Annotated[dict, Depends(require_admin)], days: int = 30, format: str = "json"):
+    cutoff = datetime.now() - timedelta(days=days)
+    rows = []
+    async for row in user_collection.aggregate([
+        {"$match": {"assignments.assigned_at": {"$lt": cutoff}}},
+        {"$unwind": "$assignments"},
+        {"$match": {"assignments.assigned_at": {"$lt": cutoff}}},
+        {"$project": {"_id": 0, "user_name": 1, "name": 1, "role": 1, "video": "$assignments.video", "assigned_at": "$assignments.assigned_at"}},
+        {"$sort": {"assigned_at": 1}},
+    ], allowDiskUse=True):
+        rows.append(jsonable(row))
+    return report_response(rows, ["user_name", "name", "role", "video", "assigned_at"], format, "overdue")
+
+
+# Average score and attempts per user.
+@router.get("/reports/users", response_description="Completions and average score per user.")
+async def get_user_report(user: Annotated[dict, Depends(require_admin)], format: str = "json"):
+    rows = []
+    async for row in completion_collection.aggregate([
+        {"$group": {"_id": "$user_name", "role": {"$first": "$role"}, "completions": {"$sum": 1}, "average_score": {"$avg": "$score"}, "last_completed_at": {"$max": "$completed_at"}}},
+        {"$sort": {"_id": 1}},
+    ], allowDiskUse=True):
+        rows.append(jsonable({"user_name": row["_id"], "role": row["role"], "completions": row["completions"], "average_score": round(row["average_score"], 2) if row["average_score"] is not None else None, "last_completed_at": row["last_completed_at"]}))
+    return report_response(rows, ["user_name", "role", "completions", "average_score", "last_completed_at"], format, "users")
+
+
+
+# Exports
+# Rows are streamed from the Mongo cursor and flushed every EXPORT_BATCH_SIZE
+# rows, so memory use doesn't depend on how many completions are exported.
+EXPORT_FIELDS = ["completed_at", "user_name", "role", "video", "uuid", "score"]
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def csv_chunks(completions):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_FIELDS)
+    rows = 0
+    async for completion in completions:
+        writer.writerow([export_value(completion.get(field)) for field in EXPORT_FIELDS])
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield out.getvalue().encode()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode()
+
+
+async def ndjson_chunks(completions):
+    lines = []
+    async for completion in completions:
+        lines.append(json.dumps({field: export_value(completion.get(field)) for field in EXPORT_FIELDS}))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield ("\n".join(lines) + "\n").encode()
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode()
+
+
+class ChunkBuffer(io.RawIOBase):
+    # Write-only, unseekable file object: zipfile falls back to data
+    # descriptors, so the archive can be sent while it's being written.
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+XLSX_PARTS = {
+    "[Content_Types].xml": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/><Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/></Types>',
+    "_rels/.rels": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/></Relationships>',
+    "xl/workbook.xml": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets><sheet name="Completions" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    "xl/_rels/workbook.xml.rels": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/></Relationships>',
+}
+
+
+def xlsx_row(values):
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f"<c><v>{value}</v></c>")
+        elif value is not None:
+            cells.append(f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>')
+        else:
+            cells.append("<c/>")
+    return f"<row>{''.join(cells)}</row>"
+
+
+async def xlsx_chunks(completions):
+    buffer = ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as workbook:
+        for name, part in XLSX_PARTS.items():
+            workbook.writestr(name, part)
+        with workbook.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            sheet.write(xlsx_row(EXPORT_FIELDS).encode())
+            rows = 0
+            async for completion in completions:
+                sheet.write(xlsx_row([export_value(completion.get(field)) for field in EXPORT_FIELDS]).encode())
+                rows += 1
+                if rows % EXPORT_BATCH_SIZE == 0:
+                    yield buffer.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield buffer.drain()
+
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+EXPORT_WRITERS = {"csv": csv_chunks, "ndjson": ndjson_chunks, "xlsx": xlsx_chunks}
+
+
+def export_response(completions, format: str, accept_encoding: str = None):
+    if format not in EXPORT_WRITERS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format {format}.")
+    chunks = EXPORT_WRITERS[format](completions)
+    headers = {"Content-Disposition": f'attachment; filename="completions.{format}"'}
+    # xlsx is already a zip archive; compressing it again only costs CPU.
+    if format != "xlsx" and "gzip" in (accept_encoding or ""):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(chunks, media_type=EXPORT_MEDIA_TYPES[format], headers=headers)
+
+
+@router.get("/reports/completions/export", response_description="Stream the completion history as CSV, NDJSON or XLSX.")
+async def export_completions(user: Annotated[dict, Depends(require_admin)], format: str = "csv", start: datetime = None, end: datetime = None, role: str = None, video: str = None, user_name: str = None, accept_encoding: Annotated[str | None, Header()] = None):
+    query = {}
+    if start or end:
+        query["completed_at"] = {}
+        if start:
+            query["completed_at"]["$gte"] = start
+        if end:
+            query["completed_at"]["$lt"] = end
+    if role:
+        query["role"] = role
+    if video:
+        query["video"] = video
+    if user_name:
+        query["user_name"] = user_name
+    projection = {"_id": 0, **{field: 1 for field in EXPORT_FIELDS}}
+    completions = completion_collection.find(query, projection, batch_size=EXPORT_BATCH_SIZE).sort([("completed_at", 1), ("_id", 1)])
+    return export_response(completions, format, accept_encoding)
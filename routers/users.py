@@ -1,28 +1,27 @@
 from typing import List, Optional
-from fastapi import APIRouter, Form, HTTPException, Request, Response, status
+from fastapi import APIRouter, Depends, Form, HTTPException, Request, Response, status
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
 from pydantic import ConfigDict, BaseModel, Field
 from pydantic.functional_validators import BeforeValidator
 from typing_extensions import Annotated
 
 from bson import ObjectId
-import motor.motor_asyncio
 from pymongo import ReturnDocument, errors
 
-from quizzes import Quiz
-from routers.vids import get_video_by_uuid
+import events
+import metrics
+from database import completion_collection, user_collection
+from dependencies import get_current_user, require_admin, session_cache, session_version, sign_session
+from passwords import HashPoolBusy, hash_password, ip_throttle, login_in_flight, login_priority, login_retry_after, needs_rehash, user_throttle, verify_password
+from templating import invalidate_user, templates
+from routers.vids import get_video_by_uuid, get_video_quiz
 from datetime import datetime
+import logging
 import re
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
+logger = logging.getLogger("training.users")
 
 
-client = motor.motor_asyncio.AsyncIOMotorClient("127.0.0.1:27017")
-db = client.train
-user_collection = db.get_collection('users')
-
-vid_collection = db.get_collection("vids")
 # Represents an ObjectId field in the database.
 # It will be represented as a `str` on the model so that it can be serialized to JSON.
 PyObjectId = Annotated[str, BeforeValidator(str)]
@@ -55,8 +54,9 @@ class UpdateUserModel(BaseModel):
 
 # Create a user.
 @router.post("/users", response_description="Create a User", response_model=UserModel, status_code=status.HTTP_201_CREATED, response_model_by_alias=False)
-async def create_user(request: Request, name: Annotated[str, Form()], role: Annotated[str, Form()], user_name:Annotated[str, Form()], email:Annotated[str, Form()], password:Annotated[str, Form()], admin:Annotated[str, Form()] = False):
+async def create_user(request: Request, current_user: Annotated[dict, Depends(require_admin)], name: Annotated[str, Form()], role: Annotated[str, Form()], user_name:Annotated[str, Form()], email:Annotated[str, Form()], password:Annotated[str, Form()], admin:Annotated[str, Form()] = False):
     try:
+        password = await hash_password(password)
         user: UserModel = {"name": name, "role": role, "email": email, "user_name": user_name, "email": email, "password": password, "admin": admin, "content_assigned": [], "content_completed": [], "quiz_scores": []}
         new_user = await user_collection.insert_one(user)
 
@@ -64,14 +64,20 @@ async def create_user(request: Request, name: Annotated[str, Form()], role: Anno
         return RedirectResponse(f"/v/administration", status_code=status.HTTP_303_SEE_OTHER)
     except errors.DuplicateKeyError:
         context = {"request": request, "error": "Username is already taken!"}
-        return templates.TemplateResponse("add_user.html", context)
+        return templates.TemplateResponse(request, "add_user.html", context)
+    except HashPoolBusy:
+        context = {"request": request, "error": "The server is busy, try again shortly."}
+        return templates.TemplateResponse(request, "add_user.html", context, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 # Delete a user.
-@router.get("/user/{id}/delete", response_description="Delete user", response_model=UserModel, response_model_by_alias=False)
-async def delete_user(id: str):
+@router.delete("/user/{id}", response_description="Delete user", response_model=UserModel, response_model_by_alias=False)
+async def delete_user(id: str, current_user: Annotated[dict, Depends(require_admin)]):
     user = await user_collection.find_one(({"user_name": id}))
     if user is not None:
         delete_result = await user_collection.delete_one(({"user_name": id}))
+        session_cache.invalidate(id)
+        invalidate_user(id)
+        events.emit("user", id)
         if delete_result.deleted_count == 1:
              return Response(status_code=status.HTTP_204_NO_CONTENT)
         else:
@@ -79,47 +85,91 @@ async def delete_user(id: str):
     else:
         raise HTTPException(status_code=404, detail=f"User {id} not found.")
 
+# Change a user's role.
+@router.post("/user/{id}/role", response_description="Change a user's role", response_model=UserModel, response_model_by_alias=False)
+async def update_user_role(id: str, user: Annotated[dict, Depends(require_admin)], role: Annotated[str | None, Form()] = None, admin: Annotated[str | None, Form()] = None):
+    # Only the fields in the form are changed, so a role change doesn't demote an admin.
+    changes = {field: value for field, value in (("role", role), ("admin", admin)) if value is not None}
+    if not changes:
+        raise HTTPException(status_code=400, detail="Nothing to change.")
+    update_result = await user_collection.find_one_and_update(
+        {"user_name": id},
+        {"$set": changes}
+    )
+    session_cache.invalidate(id)
+    invalidate_user(id)
+    events.emit("user", id)
+    if update_result is not None:
+        return RedirectResponse(f"/v/user/{id}", status_code=status.HTTP_303_SEE_OTHER)
+    else:
+        raise HTTPException(status_code=404, detail=f"User {id} not found.")
+
 @router.post("/login", response_description="Login as a user.", response_class=HTMLResponse)
 async def login(request: Request, response: Response, user_name:Annotated[str, Form()] = None, password:Annotated[str, Form()] = None):
     if user_name is not None and password is not None:
-        user = await user_collection.find_one({'user_name': user_name})
-        context = {"request": request, 'user': user}
+        # Behind a proxy this is the forwarded client address, provided the
+        # server trusts the proxy's headers (see Deployment in the README).
+        address = request.client.host if request.client else ""
+        # Throttled attempts are turned away before they cost a hash.
+        retry_after = login_retry_after(user_name, address)
+        if retry_after:
+            context = {"request": request, "error": "Too many login attempts, try again later."}
+            return templates.TemplateResponse(request, "login.html", context, status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers={"Retry-After": str(retry_after)})
+        priority = login_priority(address)
+        with login_in_flight(address):
+            user = await user_collection.find_one({'user_name': user_name})
+            context = {"request": request, 'user': user}
+            try:
+                matched = await verify_password(password, user['password'] if user is not None else None, priority)
+            except HashPoolBusy:
+                context = {"request": request, "error": "The server is busy, try again shortly."}
+                return templates.TemplateResponse(request, "login.html", context, status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
         # If the user exists check if the password matches.
-        if user is not None:
-            if user['password'] == password:
-                response = templates.TemplateResponse("index.html", context)
-                response.set_cookie(key="user", value=user['user_name'])
-                # If the user is the admin set the admin cookie. #TODO
-                if user['admin'] == True:
-                    response.set_cookie(key="admin", value=True)
-                    return response
-                else:
-                    return response
-            else:
-                context = {"request": request, "error": "Username or password is incorrect"}
-                response = templates.TemplateResponse("login.html", context)
-                return response
+        if matched:
+            user_throttle.reset(user_name)
+            if needs_rehash(user['password']):
+                await upgrade_password(user, password)
+            response = templates.TemplateResponse(request, "index.html", context)
+            session_cache.put(user['user_name'], user)
+            response.set_cookie(key="session", value=sign_session(user['user_name'], session_version(user)), httponly=True, samesite="lax")
+            return response
         else:
+            user_throttle.record(user_name)
+            ip_throttle.record(address)
             context = {"request": request, "error": "Username or password is incorrect"}
-            response = templates.TemplateResponse("login.html", context)
+            response = templates.TemplateResponse(request, "login.html", context)
             return response
     else:
         context = {"request": request, "error": "You must enter a username and password!"}
-        response = templates.TemplateResponse("login.html", context)
+        response = templates.TemplateResponse(request, "login.html", context)
         return response
 
+async def upgrade_password(user: dict, password: str):
+    # Plaintext (or outdated) records are rehashed the first time their owner logs in.
+    try:
+        user['password'] = await hash_password(password)
+    except HashPoolBusy:
+        return
+    await user_collection.update_one({"_id": user["_id"]}, {"$set": {"password": user['password']}})
+
 @router.get("/logout", response_description="Logout", response_class=RedirectResponse)
-async def logout(request: Request, response: Response):
+async def logout(request: Request, response: Response, user: Annotated[dict | None, Depends(get_current_user)]):
 
     context = {"request": request}
+    if user is not None:
+        # Revokes the token even if the cookie was copied. Other workers notice
+        # once their cached copy of the user expires (SESSION_CACHE_TTL).
+        await user_collection.update_one({"_id": user["_id"]}, {"$inc": {"session_version": 1}})
+        session_cache.invalidate(user["user_name"])
     response = RedirectResponse("/")
+    response.delete_cookie("session")
     response.delete_cookie("user")
     response.delete_cookie("admin")
     return response
 
 # Assign content to a user.
 @router.post("/user/{id}/ac/", response_description="Assign content to a user.", response_model=UserModel, response_model_by_alias=False)
-async def update_user_content(id:str, vid:Annotated[str, Form()]):
+async def assign_user_content(id:str, vid:Annotated[str, Form()], current_user: Annotated[dict, Depends(require_admin)]):
     user = await user_collection.find_one(({"user_name": id}))
     if user is not None:
         # Check if user already has the file assigned to them.
@@ -131,8 +181,11 @@ async def update_user_content(id:str, vid:Annotated[str, Form()]):
         else:
             update_result = await user_collection.find_one_and_update(
                 {"user_name": id },
-                {"$push": { "content_assigned": vid}}
+                {"$push": { "content_assigned": vid, "assignments": {"video": vid, "assigned_at": datetime.now()}}}
             )
+            session_cache.invalidate(id)
+            invalidate_user(id)
+            events.emit("user", id)
             if update_result is not None:
                 return RedirectResponse(f"/", status_code=status.HTTP_302_FOUND)
     else:
@@ -140,7 +193,12 @@ async def update_user_content(id:str, vid:Annotated[str, Form()]):
 
 # Add content to a user's completed content and score the quiz. 
 @router.post("/user/{id}/content/vids/{uuid}/{vid}/c", response_description="Add content to a user's completed content.", response_class=HTMLResponse)
-async def update_user_content(id:str, vid:str, uuid: str, Option1: Annotated[str, Form()] = None, Option2: Annotated[str, Form()] = None, Option3: Annotated[str, Form()] = None, Option4: Annotated[str, Form()] = None, Option5: Annotated[str, Form()] = None, Option6: Annotated[str, Form()] = None, Option7: Annotated[str, Form()] = None, Option8: Annotated[str, Form()] = None, Option9: Annotated[str, Form()] = None, Option10: Annotated[str, Form()] = None, Option11: Annotated[str, Form()] = None, Option12: Annotated[str, Form()] = None, Option13: Annotated[str, Form()] = None, Option14: Annotated[str, Form()] = None):
+async def update_user_content(request: Request, id:str, vid:str, uuid: str, current_user: Annotated[dict | None, Depends(get_current_user)]):
+    # Only the signed-in user can submit their own quiz.
+    if current_user is None:
+        raise HTTPException(status_code=401)
+    if current_user["user_name"] != id:
+        raise HTTPException(status_code=403)
     user = await user_collection.find_one(({"user_name": id}))
     # Video ID + Date
     if user is not None:
@@ -148,57 +206,30 @@ async def update_user_content(id:str, vid:str, uuid: str, Option1: Annotated[str
         if vid in user["content_completed"]:
             raise HTTPException(status_code=409, detail=f"User has already completed {vid}")
         else:
+            # One form field per question: q0, q1, ...
+            form = await request.form()
+            answers = {key: value for key, value in form.items() if re.fullmatch(r"q\d+", key)}
 
-            # Open the video's quiz file.
-            options = []
-            options.append(Option1)
-            options.append(Option2)
-            options.append(Option3)
-            options.append(Option4)
-            options.append(Option5)
-            options.append(Option6)
-            options.append(Option7)
-            options.append(Option8)
-            options.append(Option9)
-            options.append(Option10)
-            options.append(Option11)
-            options.append(Option12)
-            options.append(Option13)
-            options.append(Option14)
-
-
-
-
-
-            clean_options = []
-            for option in options:
-                if option is None:
-                    continue
-                else:
-                    parse_option = option.replace("Option", "").replace(":", "")
-                    clean_option = re.sub(r"\d", "", parse_option)
-                    clean_options.append(clean_option)
-                    print("Quiz Selection: ", clean_option)
-
-            #print(id)
-            #print(uuid)
-            #print(vid)
-            
             video = await get_video_by_uuid(vid)
-            video_quiz = Quiz()
-            video_quiz.from_file(video.quiz)
-
-            for question in video_quiz.questions:
-                print("Correct Answer: ", question.correct_answer)
+            video_quiz = get_video_quiz(video)
 
-    
-            score = video_quiz.score_quiz(clean_options)
+            grade = video_quiz.grade(answers)
+            score = grade["score"]
+            metrics.log_sampled(logger, "quiz_graded", user_name=id, video=vid, answers=answers, score=score, results=grade["results"])
             date = datetime.now()
 
+            # The completion record holds the details; the user only keeps the
+            # video name so "already completed" checks stay a simple lookup.
+            completion = {"user_name": id, "role": user.get("role"), "uuid": video.uuid, "video": vid, "answers": answers, "score": score, "results": grade["results"], "completed_at": date}
+            await completion_collection.insert_one(completion)
             update_result = await user_collection.find_one_and_update(
                 {"user_name": id},
-                {"$push": { "content_completed": f"{date.month}/{date.day}/{date.year}, {date.hour}:{date.minute}, {vid}:  {score}%"}, "$pull": { "content_assigned": vid}}
+                {"$addToSet": { "content_completed": vid}, "$pull": { "content_assigned": vid, "assignments": {"video": vid}}}
             )
+            session_cache.invalidate(id)
+            invalidate_user(id)
+            events.emit("completion", completion)
+            events.emit("user", id)
             if update_result is not None:
                 return RedirectResponse("/", status_code=status.HTTP_302_FOUND)
             else:
@@ -1,61 +1,233 @@
+import asyncio
+import fcntl
 import os
 from typing import List, Optional
-from fastapi import APIRouter, Cookie, HTTPException, Request, UploadFile, status
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
+from fastapi import APIRouter, Depends, Form, Header, HTTPException, Request, Response, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from pydantic import ConfigDict, BaseModel, Field
 from pydantic.functional_validators import BeforeValidator
 from typing_extensions import Annotated
 
 from bson import ObjectId
-import motor.motor_asyncio
-from pymongo import ReturnDocument, errors
+from pymongo import ReturnDocument, UpdateOne, errors
+from contextlib import asynccontextmanager
+from datetime import timedelta
 from pathlib import Path
+from email.utils import formatdate, parsedate
 import uuid
-import glob
+import logging
+import hashlib
+import json
+import re
 from pox.shutils import find
 
 from quizzes import *
+import media
+import metrics
+import storage
+from database import completion_collection, vid_collection
+from dependencies import get_current_user, require_admin
+from templating import invalidate_videos, templates
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
-
-client = motor.motor_asyncio.AsyncIOMotorClient("127.0.0.1:27017")
-db = client.train
-
-user_collection = db.get_collection("users")
+logger = logging.getLogger("training.vids")
 
 
+VIDS_DIR = storage.VIDS_DIR
+# Other nodes index uploads and record processing results; pick them up this often.
+CATALOG_REFRESH_SECONDS = int(os.environ.get("CATALOG_REFRESH_SECONDS", 60))
+# Refreshes re-read entries stamped this long before the newest one seen, in
+# case a write stamped just before the last refresh committed just after it.
+CATALOG_REFRESH_OVERLAP = timedelta(seconds=5)
 
 
 
 class Video:
-    def __init__(self, uuid:str = None, quiz:str = None, mp4:str = None):
+    def __init__(self, uuid:str = None, quiz:str = None, mp4:str = None, filename:str = None, mtime:float = None, sha256:str = None, questions:list[dict] = None, quiz_mtime:float = None, media:dict = None):
         self.uuid = uuid
         self.quiz = quiz
         self.mp4 = mp4
+        self.filename = filename
+        self.mtime = mtime
+        self.sha256 = sha256
+        # The quiz compiled at upload/index time, so views never parse the .txt.
+        self.questions = questions
+        self.quiz_mtime = quiz_mtime
+        # Set by the media worker: duration, faststart, renditions and poster.
+        self.media = media
 
+    @classmethod
+    def from_document(cls, document: dict):
+        return cls(uuid=document["uuid"], quiz=document.get("quiz"), mp4=document.get("mp4"), filename=document.get("filename"), mtime=document.get("mtime"), sha256=document.get("sha256"), questions=document.get("questions"), quiz_mtime=document.get("quiz_mtime"), media=document.get("media"))
 
+    def to_document(self):
+        return {"uuid": self.uuid, "quiz": self.quiz, "mp4": self.mp4, "filename": self.filename, "mtime": self.mtime, "sha256": self.sha256, "questions": self.questions, "quiz_mtime": self.quiz_mtime, "media": self.media}
 
-       
-async def get_video_by_uuid(video_name: str):
-    vids = glob.glob("./vids/**/*.mp4", recursive=True)
-    video = Video()
-
-
-    for vid in vids:
-        video_pattern = re.search(video_name, vid)
-        # For each video file find the parent directory of the file.
-        if video_pattern:
-           video_path = re.sub(video_name, " ", video_pattern.string).rstrip()
-           quizzes = glob.glob(f"{video_path}*.txt", recursive=True)
-           for quiz in quizzes:
-            if len(quizzes) == 1:
-                video.quiz = quiz
-           video.mp4=video_pattern.string
-        else:
+
+# In-process copy of the `vids` collection so lookups never touch the filesystem.
+# Videos are reachable both by their upload uuid and by their .mp4 file name,
+# which is what users' content_assigned lists and the admin views store.
+catalog: dict[str, Video] = {}
+catalog_by_name: dict[str, Video] = {}
+# Newest updated_at (Mongo server time) seen in the collection; refreshes only fetch entries changed since.
+catalog_updated_at = None
+
+
+def add_to_catalog(video: Video):
+    catalog[video.uuid] = video
+    catalog_by_name[video.filename] = video
+    invalidate_videos()
+
+
+def remove_from_catalog(uuid: str):
+    video = catalog.pop(uuid, None)
+    if video is not None and catalog_by_name.get(video.filename) is video:
+        del catalog_by_name[video.filename]
+    invalidate_videos()
+
+
+def compile_quiz(video: Video):
+    quiz = Quiz()
+    quiz.from_file(video.quiz)
+    video.questions = quiz.to_dict()
+    video.quiz_mtime = os.stat(video.quiz).st_mtime
+
+
+def scan_video_dir(uuid: str):
+    # Build a catalog entry from a single ./vids/<uuid>/ directory.
+    path = os.path.join(VIDS_DIR, uuid)
+    video = Video(uuid=uuid, mtime=os.stat(path).st_mtime)
+    for entry in os.scandir(path):
+        if entry.name.endswith(".mp4"):
+            video.mp4 = f"{path}/{entry.name}"
+            video.filename = entry.name
+        elif entry.name.endswith(".txt"):
+            video.quiz = f"{path}/{entry.name}"
+    if video.mp4 is None:
+        return None
+    if video.quiz is not None:
+        compile_quiz(video)
+    return video
+
+
+def is_indexed(video: Video, mtime: float):
+    if video is None or video.mtime != mtime:
+        return False
+    if video.quiz is None:
+        return True
+    # Quiz files edited in place don't change the directory mtime.
+    try:
+        return video.questions is not None and video.quiz_mtime == os.stat(video.quiz).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def changed_video_dirs():
+    if not os.path.isdir(VIDS_DIR):
+        return set(), []
+    dirs = set()
+    changed = []
+    for entry in os.scandir(VIDS_DIR):
+        if entry.is_dir():
+            dirs.add(entry.name)
+            if not is_indexed(catalog.get(entry.name), entry.stat().st_mtime):
+                changed.append(entry.name)
+    return dirs, changed
+
+
+def get_video_quiz(video: Video):
+    # Served from memory: the catalog entry already holds the compiled quiz.
+    return get_cached_quiz(video.uuid, video.quiz_mtime, lambda: Quiz.from_dict(video.questions or []))
+
+
+async def index_video(video: Video):
+    invalidate_quiz(video.uuid)
+    add_to_catalog(video)
+    await vid_collection.update_one({"uuid": video.uuid}, {"$set": video.to_document(), "$currentDate": {"updated_at": True}}, upsert=True)
+
+
+def note_updated_at(document: dict):
+    global catalog_updated_at
+    updated_at = document.get("updated_at")
+    if updated_at is not None and (catalog_updated_at is None or updated_at > catalog_updated_at):
+        catalog_updated_at = updated_at
+
+
+async def load_catalog():
+    async for document in vid_collection.find({}, {"_id": 0}):
+        note_updated_at(document)
+        add_to_catalog(Video.from_document(document))
+
+
+def sync_catalog_entry(document: dict):
+    # Only a real change replaces the entry, so an idle refresh doesn't
+    # invalidate the cached video lists.
+    note_updated_at(document)
+    video = Video.from_document(document)
+    current = catalog.get(video.uuid)
+    if current is None or current.to_document() != video.to_document():
+        add_to_catalog(video)
+
+
+async def refresh_catalog():
+    while True:
+        await asyncio.sleep(CATALOG_REFRESH_SECONDS)
+        # Entries indexed before updated_at existed were loaded at startup, and
+        # any later change to them stamps one.
+        since = {"$exists": True} if catalog_updated_at is None else {"$gte": catalog_updated_at - CATALOG_REFRESH_OVERLAP}
+        try:
+            documents = await vid_collection.find({"updated_at": since}, {"_id": 0}).to_list(None)
+            # Deletions leave nothing to fetch by date; the uuid index answers this alone.
+            indexed = {document["uuid"] async for document in vid_collection.find({}, {"_id": 0, "uuid": 1})}
+        except errors.PyMongoError:
+            logger.warning("could not refresh the video catalog", exc_info=True)
             continue
+        for document in documents:
+            sync_catalog_entry(document)
+        for video_uuid in [video_uuid for video_uuid in catalog if video_uuid not in indexed]:
+            remove_from_catalog(video_uuid)
+
+
+async def reindex_videos():
+    # Incrementally sync the catalog with ./vids: only directories that are new
+    # or have changed since they were indexed are scanned.
+    await load_catalog()
+    if not storage.backend.local:
+        # ./vids is only this node's scratch copy; the catalog in Mongo is the record.
+        return {"indexed": 0, "removed": 0, "total": len(catalog)}
+    with metrics.timed(metrics.video_scan_duration, "list"):
+        dirs, changed = await run_in_threadpool(changed_video_dirs)
+    indexed = 0
+    for video_uuid in changed:
+        with metrics.timed(metrics.video_scan_duration, "dir"):
+            video = await run_in_threadpool(scan_video_dir, video_uuid)
+        if video is not None:
+            # Processing output isn't rediscovered from disk; keep what the worker recorded.
+            previous = catalog.get(video_uuid)
+            if previous is not None:
+                video.media = previous.media
+            await index_video(video)
+            indexed += 1
+    removed = [video_uuid for video_uuid in catalog if video_uuid not in dirs]
+    for video_uuid in removed:
+        remove_from_catalog(video_uuid)
+    if removed:
+        await vid_collection.delete_many({"uuid": {"$in": removed}})
+    return {"indexed": indexed, "removed": len(removed), "total": len(catalog)}
+
 
+async def get_video_by_uuid(video_name: str):
+    with metrics.timed(metrics.video_lookup_duration, "catalog"):
+        video = catalog.get(video_name) or catalog_by_name.get(video_name)
+    if video is None:
+        # Another process may have indexed it since we loaded the catalog.
+        with metrics.timed(metrics.video_lookup_duration, "mongo"):
+            document = await vid_collection.find_one({"$or": [{"uuid": video_name}, {"filename": video_name}]}, {"_id": 0})
+        if document is None:
+            return Video()
+        video = Video.from_document(document)
+        add_to_catalog(video)
     return video
     
 
@@ -65,55 +237,413 @@ async def get_vids():
     return {"vids": x.mp4}
 
 async def get_videos():
-    mp4_files = glob.iglob("./vids/**/*.mp4", recursive=True)
+    mp4_files = [video.mp4 for video in catalog.values()]
     return mp4_files
 
 
+@router.post("/videos/reindex", response_description="Rebuild the video catalog from ./vids.")
+async def reindex(user: Annotated[dict, Depends(require_admin)]):
+    return await reindex_videos()
+
+
+
+
+# Uploads are streamed to disk in chunks of this size so memory stays flat
+# no matter how large the video is.
+CHUNK_SIZE = 1024 * 1024
+# Resumable uploads are appended to across requests, so with several nodes
+# this must be a shared volume (or the load balancer must keep clients on one node).
+UPLOADS_DIR = os.environ.get("UPLOADS_DIR", "./uploads")
+
+
+def write_chunk(out, checksum, chunk: bytes):
+    checksum.update(chunk)
+    out.write(chunk)
+
+
+def hash_file(file_path: str):
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as in_file:
+        while chunk := in_file.read(CHUNK_SIZE):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+async def save_upload(file: UploadFile, destination: str):
+    # Write to a temp file next to the destination and rename it into place so
+    # a half-written video is never visible to the catalog.
+    checksum = hashlib.sha256()
+    temp_path = f"{destination}.part"
+    out = await run_in_threadpool(open, temp_path, "wb")
+    try:
+        while chunk := await file.read(CHUNK_SIZE):
+            await run_in_threadpool(write_chunk, out, checksum, chunk)
+    finally:
+        await run_in_threadpool(out.close)
+    await run_in_threadpool(os.replace, temp_path, destination)
+    return checksum.hexdigest()
+
+
+async def save_quiz(quiz: UploadFile, destination: str):
+    quiz_content = (await quiz.read()).decode("utf-8")
+    def write_quiz():
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, "w") as quiz_file:
+            quiz_file.write(quiz_content)
+    await run_in_threadpool(write_quiz)
 
 
 @router.post("/upload_qv", response_description="Upload quiz and video file.", status_code=status.HTTP_202_ACCEPTED)
-async def upload_vid_and_quiz(quiz: UploadFile, video: UploadFile):
+async def upload_vid_and_quiz(quiz: UploadFile, video: UploadFile, user: Annotated[dict, Depends(require_admin)]):
     if quiz and video:
         if quiz.content_type == "text/plain" and video.content_type == "video/mp4":
 
             id = str(uuid.uuid4())
-            path = Path(f"./vids/{id}")
+            path = Path(VIDS_DIR) / id
             path.mkdir(parents=True, exist_ok=True)
 
-            files = [quiz, video]
-
-            for file in files:
-                if file.content_type == "video/mp4":
-                    file_content = await file.read()
-                    video_file = open(f"{path}/{file.filename}", "w+b")
-                    video_file.write(file_content)
+            quiz_name = os.path.basename(quiz.filename)
+            video_name = os.path.basename(video.filename)
+            await save_quiz(quiz, f"{path}/{quiz_name}")
+            sha256 = await save_upload(video, f"{path}/{video_name}")
 
-                if file.content_type == "text/plain":
-                    file_content = await file.read()
-                    quiz_file = open(f"{path}/{file.filename}", "w")
-                    quiz_file.write(file_content.decode("utf-8"))
+            entry = Video(uuid=id, quiz=f"{path}/{quiz_name}", mp4=f"{path}/{video_name}", filename=video_name, mtime=os.stat(path).st_mtime, sha256=sha256)
+            await run_in_threadpool(compile_quiz, entry)
+            await storage.backend.publish(str(path))
+            await index_video(entry)
+            await media.enqueue(id)
 
             return RedirectResponse(f"/v/administration", status_code = status.HTTP_303_SEE_OTHER)
         else:
-            print("Quiz must be .txt and video must be .mp4")
+            logger.warning("rejected upload %s/%s: quiz must be .txt and video must be .mp4", quiz.filename, video.filename)
     else:
-        print("You must upload both a quiz and video file!")
+        logger.warning("rejected upload: both a quiz and a video file are required")
+
+
+# Resumable uploads.
+# A client creates an upload, PATCHes the video bytes in as many requests as it
+# needs (resuming from the offset the server reports after a dropped
+# connection) and then completes it with the quiz file.
+
+def read_upload(upload_id: str):
+    try:
+        with open(f"{UPLOADS_DIR}/{upload_id}.json") as upload_file:
+            upload = json.load(upload_file)
+        upload["offset"] = os.path.getsize(f"{UPLOADS_DIR}/{upload_id}.part")
+    except FileNotFoundError:
+        # Either file may be gone, e.g. after a partial cleanup.
+        raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found.")
+    return upload
+
+
+def lock_upload_file(upload_id: str):
+    # Blocks until no other process holds the upload; closing the file releases it.
+    try:
+        lock_file = open(f"{UPLOADS_DIR}/{upload_id}.json")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found.")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+# upload_id -> [lock, holders]; an entry goes once nothing holds or waits on it.
+upload_locks = {}
+
+
+@asynccontextmanager
+async def upload_lock(upload_id: str):
+    # Serializes PATCHes (and completion) of one upload, so a retried request
+    # can't append alongside the one it replaced. The asyncio lock queues
+    # requests within this process without tying up threads; the flock on the
+    # upload's .json covers other workers and nodes sharing UPLOADS_DIR.
+    entry = upload_locks.setdefault(upload_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            lock_file = await run_in_threadpool(lock_upload_file, upload_id)
+            try:
+                yield
+            finally:
+                await run_in_threadpool(lock_file.close)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del upload_locks[upload_id]
+
+
+@router.post("/uploads", response_description="Start a resumable video upload.", status_code=status.HTTP_201_CREATED)
+async def create_upload(user: Annotated[dict, Depends(require_admin)], filename: Annotated[str, Form()], size: Annotated[int, Form()], sha256: Annotated[str | None, Form()] = None):
+    if not filename.endswith(".mp4"):
+        raise HTTPException(status_code=400, detail="Video must be .mp4")
+    if size < 0:
+        raise HTTPException(status_code=400, detail="Size must not be negative.")
+    upload_id = str(uuid.uuid4())
+    upload = {"upload_id": upload_id, "filename": os.path.basename(filename), "size": size, "sha256": sha256}
+    def write_upload():
+        Path(UPLOADS_DIR).mkdir(parents=True, exist_ok=True)
+        with open(f"{UPLOADS_DIR}/{upload_id}.json", "w") as upload_file:
+            json.dump(upload, upload_file)
+        open(f"{UPLOADS_DIR}/{upload_id}.part", "wb").close()
+    await run_in_threadpool(write_upload)
+    return {**upload, "offset": 0}
+
+
+@router.get("/uploads/{upload_id}", response_description="Get the offset to resume an upload from.")
+async def get_upload(upload_id: str, user: Annotated[dict, Depends(require_admin)]):
+    upload = await run_in_threadpool(read_upload, upload_id)
+    return JSONResponse(upload, headers={"Upload-Offset": str(upload["offset"])})
+
+
+@router.patch("/uploads/{upload_id}", response_description="Append video bytes to an upload.")
+async def append_upload(request: Request, upload_id: str, upload_offset: Annotated[int, Header()], user: Annotated[dict, Depends(require_admin)]):
+    async with upload_lock(upload_id):
+        upload = await run_in_threadpool(read_upload, upload_id)
+        if upload_offset != upload["offset"]:
+            raise HTTPException(status_code=409, detail=f"Upload is at offset {upload['offset']}", headers={"Upload-Offset": str(upload["offset"])})
+
+        offset = upload["offset"]
+        too_large = False
+        out = await run_in_threadpool(open, f"{UPLOADS_DIR}/{upload_id}.part", "ab")
+        try:
+            buffer = bytearray()
+            async for chunk in request.stream():
+                # Bytes past the declared size are never written.
+                space = upload["size"] - offset - len(buffer)
+                if len(chunk) > space:
+                    too_large = True
+                    chunk = chunk[:space]
+                buffer.extend(chunk)
+                if len(buffer) >= CHUNK_SIZE or too_large:
+                    await run_in_threadpool(out.write, bytes(buffer))
+                    offset += len(buffer)
+                    buffer.clear()
+                if too_large:
+                    break
+            if buffer:
+                await run_in_threadpool(out.write, bytes(buffer))
+                offset += len(buffer)
+        finally:
+            await run_in_threadpool(out.close)
+    if too_large:
+        raise HTTPException(status_code=400, detail=f"Upload is larger than the declared {upload['size']} bytes.", headers={"Upload-Offset": str(offset)})
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={"Upload-Offset": str(offset)})
+
+
+@router.post("/uploads/{upload_id}/complete", response_description="Finish an upload with its quiz file.", status_code=status.HTTP_201_CREATED)
+async def complete_upload(upload_id: str, quiz: UploadFile, user: Annotated[dict, Depends(require_admin)]):
+    if quiz.content_type != "text/plain":
+        raise HTTPException(status_code=400, detail="Quiz must be .txt")
+    # Held until the upload is moved, so a late PATCH can't append to it meanwhile.
+    async with upload_lock(upload_id):
+        upload = await run_in_threadpool(read_upload, upload_id)
+        if upload["offset"] != upload["size"]:
+            raise HTTPException(status_code=409, detail=f"Upload is at offset {upload['offset']} of {upload['size']}", headers={"Upload-Offset": str(upload["offset"])})
+        part_path = f"{UPLOADS_DIR}/{upload_id}.part"
+        sha256 = await run_in_threadpool(hash_file, part_path)
+        if upload["sha256"] is not None and upload["sha256"] != sha256:
+            raise HTTPException(status_code=422, detail="Checksum does not match the uploaded video.")
+
+        id = str(uuid.uuid4())
+        path = Path(VIDS_DIR) / id
+        path.mkdir(parents=True, exist_ok=True)
+        quiz_name = os.path.basename(quiz.filename)
+        await save_quiz(quiz, f"{path}/{quiz_name}")
+        await run_in_threadpool(os.replace, part_path, f"{path}/{upload['filename']}")
+        await run_in_threadpool(os.remove, f"{UPLOADS_DIR}/{upload_id}.json")
+
+    video = Video(uuid=id, quiz=f"{path}/{quiz_name}", mp4=f"{path}/{upload['filename']}", filename=upload["filename"], mtime=os.stat(path).st_mtime, sha256=sha256)
+    await run_in_threadpool(compile_quiz, video)
+    await storage.backend.publish(str(path))
+    await index_video(video)
+    await media.enqueue(id)
+    return video.to_document()
+
+
+@router.post("/videos/{id}/quiz", response_description="Replace the quiz for a video.")
+async def replace_quiz(id: str, quiz: UploadFile, user: Annotated[dict, Depends(require_admin)]):
+    if quiz.content_type != "text/plain":
+        raise HTTPException(status_code=400, detail="Quiz must be .txt")
+    video = await get_video_by_uuid(id)
+    if video.mp4 is None:
+        raise HTTPException(status_code=404, detail=f"Video {id} not found.")
+    if video.quiz is None:
+        video.quiz = f"{os.path.dirname(video.mp4)}/{os.path.basename(quiz.filename)}"
+    await save_quiz(quiz, video.quiz)
+    await run_in_threadpool(compile_quiz, video)
+    await storage.backend.publish(video.quiz)
+    video.mtime = os.stat(os.path.dirname(video.mp4)).st_mtime
+    await index_video(video)
+    await regrade_submissions(video)
+    return RedirectResponse(f"/v/administration", status_code = status.HTTP_303_SEE_OTHER)
+
+
+REGRADE_BATCH_SIZE = 1000
+
+
+async def write_regrades(quiz: Quiz, batch: list[dict]):
+    grades = await run_in_threadpool(quiz.grade_many, [submission["answers"] for submission in batch])
+    await completion_collection.bulk_write([UpdateOne({"_id": submission["_id"]}, {"$set": {"score": grade["score"], "results": grade["results"]}}) for submission, grade in zip(batch, grades)], ordered=False)
+    return len(batch)
+
+
+async def regrade_submissions(video: Video):
+    # Regrade every stored submission for a video against its current answer key.
+    quiz = get_video_quiz(video)
+    regraded = 0
+    batch = []
+    async for submission in completion_collection.find({"uuid": video.uuid, "answers": {"$exists": True}}, {"answers": 1}):
+        batch.append(submission)
+        if len(batch) >= REGRADE_BATCH_SIZE:
+            regraded += await write_regrades(quiz, batch)
+            batch = []
+    if batch:
+        regraded += await write_regrades(quiz, batch)
+    return regraded
+
+
+@router.post("/videos/{id}/regrade", response_description="Regrade all submissions for a video.")
+async def regrade(id: str, user: Annotated[dict, Depends(require_admin)]):
+    video = await get_video_by_uuid(id)
+    if video.mp4 is None:
+        raise HTTPException(status_code=404, detail=f"Video {id} not found.")
+    return {"regraded": await regrade_submissions(video)}
+
+
+# Playback height used when the client doesn't ask for one.
+DEFAULT_PLAYBACK_HEIGHT = int(os.environ.get("DEFAULT_PLAYBACK_HEIGHT", 720))
+SAVE_DATA_PLAYBACK_HEIGHT = 360
+
+
+def pick_rendition(video: Video, max_height: int = None):
+    # The lightest file that is still good enough: the original if it is no
+    # taller than max_height, otherwise the tallest rendition that fits.
+    info = video.media or {}
+    renditions = info.get("renditions") or []
+    max_height = max_height or DEFAULT_PLAYBACK_HEIGHT
+    if not renditions or (info.get("height") or 0) <= max_height:
+        return f"/video/vids/{video.uuid}/{video.filename}"
+    fitting = [rendition for rendition in renditions if rendition["height"] <= max_height]
+    rendition = max(fitting, key=lambda rendition: rendition["height"]) if fitting else min(renditions, key=lambda rendition: rendition["height"])
+    return f"/video/vids/{video.uuid}/renditions/{os.path.basename(rendition['path'])}"
+
+
+def hls_url(video: Video):
+    hls = (video.media or {}).get("hls")
+    if hls is None:
+        return None
+    return f"/hls/{video.uuid}/{hls['token']}/{hls['playlist']}"
 
 
 @router.get("/v/video/{id}", response_description="View a video by UUID")
-async def show_video(request: Request, id:str, user: Annotated[str | None, Cookie()] = None):
+async def show_video(request: Request, id:str, user: Annotated[dict | None, Depends(get_current_user)], quality: int = None):
      context = {"request": request, "id": id}
      # Find the video folder and return the .mp4 name.
      video = await get_video_by_uuid(id)
-     video_quiz = Quiz()
-     video_quiz.from_file(video.quiz)
+     if video.mp4 is None:
+         raise HTTPException(status_code=404, detail=f"Video {id} not found.")
+     video_quiz = get_video_quiz(video)
+
+     if quality is None and request.headers.get("save-data") == "on":
+         quality = SAVE_DATA_PLAYBACK_HEIGHT
+     poster = (video.media or {}).get("poster")
+     context = {"request": request, "uuid": video.uuid, "filename": video.filename, "src": pick_rendition(video, quality), "poster": f"/video/vids/{video.uuid}/renditions/{os.path.basename(poster)}" if poster else None, "hls": hls_url(video), 'user': user, 'quiz': video_quiz}
+     return templates.TemplateResponse(request, "video.html", context)
+
+
+def is_not_modified(response_headers, request_headers):
+    # Same rules StaticFiles uses for conditional GETs.
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        return response_headers["etag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if_modified_since = parsedate(request_headers.get("if-modified-since", ""))
+    last_modified = parsedate(response_headers["last-modified"])
+    return if_modified_since is not None and last_modified is not None and if_modified_since >= last_modified
+
+
+def parse_range(header: str, size: int):
+    # A single "bytes=start-end" range as (start, end) inclusive. None means the
+    # header is ignored and the whole file is sent, which covers multi-range
+    # requests; "unsatisfiable" means a 416.
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        suffix = int(match.group(2))
+        return (max(0, size - suffix), size - 1) if suffix else "unsatisfiable"
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if match.group(2) and end < start:
+        return None
+    if start >= size:
+        return "unsatisfiable"
+    return start, min(end, size - 1)
+
+
+async def stored_file_response(request: Request, path: str, media_type: str, cache_control: str):
+    # Streams a file from a GridFS/S3 storage backend, with the conditional and
+    # single-range handling FileResponse gives local files.
+    stored = await storage.backend.stat(path)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"{os.path.basename(path)} not found.")
+    headers = {"etag": stored.etag, "last-modified": formatdate(stored.mtime, usegmt=True), "cache-control": cache_control, "accept-ranges": "bytes"}
+    if is_not_modified(headers, request.headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={key: headers[key] for key in ("etag", "last-modified", "cache-control")})
+    byte_range = None
+    if "range" in request.headers and request.headers.get("if-range", stored.etag) in (stored.etag, headers["last-modified"]):
+        byte_range = parse_range(request.headers["range"], stored.size)
+    if byte_range == "unsatisfiable":
+        return Response(status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE, headers={"content-range": f"bytes */{stored.size}"})
+    if byte_range is None:
+        start, end, status_code = 0, stored.size - 1, status.HTTP_200_OK
+    else:
+        (start, end), status_code = byte_range, status.HTTP_206_PARTIAL_CONTENT
+        headers["content-range"] = f"bytes {start}-{end}/{stored.size}"
+    headers["content-length"] = str(end - start + 1)
+    body = storage.backend.read(path, start, end) if stored.size else iter(())
+    return StreamingResponse(body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+async def file_response(request: Request, path: str, media_type: str, cache_control: str = "private, max-age=3600"):
+    if not storage.backend.local:
+        return await stored_file_response(request, path, media_type, cache_control)
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"{os.path.basename(path)} not found.")
+    # FileResponse answers Range requests itself (206, multipart/byteranges for
+    # several ranges, If-Range) and hands the file to the server with sendfile
+    # when the server supports the pathsend extension.
+    response = FileResponse(path, media_type=media_type, stat_result=stat_result, headers={"Cache-Control": cache_control})
+    if is_not_modified(response.headers, request.headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={key: response.headers[key] for key in ("etag", "last-modified", "cache-control")})
+    return response
 
-     user = await user_collection.find_one({"user_name": user})
-     context = {"request": request, "id": video.mp4, 'user': user, 'quiz': video_quiz}
-     return templates.TemplateResponse("video.html", context)
-     
 
 @router.get("/video/vids/{id}/{file}", response_description="Get a specific video file.", response_class=FileResponse)
-async def stream_video(id: str):
+async def stream_video(request: Request, id: str):
+    video = await get_video_by_uuid(id)
+    if video.mp4 is None:
+        raise HTTPException(status_code=404, detail=f"Video {id} not found.")
+    return await file_response(request, video.mp4, "video/mp4")
+
+
+@router.get("/video/vids/{id}/renditions/{file}", response_description="Get a rendition or poster of a video.", response_class=FileResponse)
+async def stream_rendition(request: Request, id: str, file: str):
+    video = await get_video_by_uuid(id)
+    info = video.media or {}
+    files = {os.path.basename(rendition["path"]): rendition["path"] for rendition in info.get("renditions") or []}
+    if info.get("poster"):
+        files[os.path.basename(info["poster"])] = info["poster"]
+    if file not in files:
+        raise HTTPException(status_code=404, detail=f"{file} not found.")
+    return await file_response(request, files[file], "image/jpeg" if file.endswith(".jpg") else "video/mp4")
+
+
+@router.post("/videos/{id}/process", response_description="Queue a video for media processing.", status_code=status.HTTP_202_ACCEPTED)
+async def process(id: str, user: Annotated[dict, Depends(require_admin)]):
     video = await get_video_by_uuid(id)
-    return video.mp4
\ No newline at end of file
+    if video.mp4 is None:
+        raise HTTPException(status_code=404, detail=f"Video {id} not found.")
+    return {"job_id": await media.enqueue(video.uuid)}
@@ -0,0 +1,235 @@
+import os
+import re
+import shutil
+from datetime import timezone
+
+from fastapi.concurrency import run_in_threadpool
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+import database
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+# Where videos, quizzes and media outputs are kept.
+# "local": files stay under VIDS_DIR; several nodes need VIDS_DIR on a shared volume.
+# "gridfs": files are copied into Mongo GridFS, so any node that reaches Mongo serves any video.
+# "s3": files are copied into an S3-compatible bucket (AWS, MinIO, ...); needs boto3.
+# With gridfs and s3, VIDS_DIR on each node is only a scratch copy.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+VIDS_DIR = os.environ.get("VIDS_DIR", "./vids")
+GRIDFS_BUCKET = os.environ.get("GRIDFS_BUCKET", "media")
+S3_BUCKET = os.environ.get("S3_BUCKET")
+# e.g. http://127.0.0.1:9000 for a local MinIO; unset for AWS. Credentials come from the usual AWS_* variables.
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+S3_PREFIX = os.environ.get("S3_PREFIX", "vids/")
+CHUNK_SIZE = 1024 * 1024
+
+
+class StorageError(Exception):
+    pass
+
+
+class StoredFile:
+    __slots__ = ("size", "mtime", "etag")
+
+    def __init__(self, size: int, mtime: float, etag: str):
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+
+
+def storage_key(path: str):
+    # Catalog entries hold local paths (./vids/<uuid>/<file>); the key is the part under VIDS_DIR.
+    key = os.path.relpath(path, VIDS_DIR).replace(os.sep, "/")
+    if key.startswith("../") or key == "..":
+        raise StorageError(f"{path} is outside {VIDS_DIR}")
+    return key
+
+
+def local_files(path: str):
+    if os.path.isfile(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            if not file.endswith(".part"):
+                yield os.path.join(root, file)
+
+
+def replace_from(write, path: str):
+    # Download next to the destination and rename it into place.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.part"
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class LocalStorage:
+    # Files are served straight from VIDS_DIR with sendfile.
+    local = True
+
+    async def publish(self, path: str):
+        pass
+
+    async def fetch(self, path: str):
+        pass
+
+    async def delete(self, path: str):
+        await run_in_threadpool(shutil.rmtree, path, ignore_errors=True)
+
+    async def check(self):
+        if not await run_in_threadpool(os.access, VIDS_DIR, os.W_OK):
+            raise StorageError(f"{VIDS_DIR} is not writable")
+
+
+class RemoteStorage:
+    # publish() copies finished local files to the store, fetch() brings a
+    # local copy back for processing, and stat()/read() serve requests.
+    local = False
+
+    async def publish(self, path: str):
+        files = await run_in_threadpool(lambda: list(local_files(path)))
+        for file in files:
+            await self.upload(storage_key(file), file)
+
+    async def fetch(self, path: str):
+        if not await run_in_threadpool(os.path.exists, path):
+            await self.download(storage_key(path), path)
+
+    async def delete(self, path: str):
+        # Removes every stored file under the directory `path`, and the local copy.
+        await self.delete_prefix(storage_key(path) + "/")
+        await run_in_threadpool(shutil.rmtree, path, ignore_errors=True)
+
+
+class GridFSStorage(RemoteStorage):
+    @property
+    def bucket(self):
+        # Built on first use so it picks up the client the app ends up with.
+        if getattr(self, "_bucket", None) is None:
+            self._bucket = AsyncIOMotorGridFSBucket(database.db, bucket_name=GRIDFS_BUCKET, chunk_size_bytes=CHUNK_SIZE)
+        return self._bucket
+
+    async def latest(self, key: str):
+        async for file in self.bucket.find({"filename": key}).sort("uploadDate", -1).limit(1):
+            return file
+        return None
+
+    async def upload(self, key: str, path: str):
+        source = await run_in_threadpool(open, path, "rb")
+        try:
+            async with self.bucket.open_upload_stream(key) as upload:
+                while chunk := await run_in_threadpool(source.read, CHUNK_SIZE):
+                    await upload.write(chunk)
+        finally:
+            await run_in_threadpool(source.close)
+        # Drop older revisions now the new one is complete.
+        async for file in self.bucket.find({"filename": key, "_id": {"$ne": upload._id}}):
+            await self.bucket.delete(file._id)
+
+    async def download(self, key: str, path: str):
+        file = await self.latest(key)
+        if file is None:
+            raise StorageError(f"{key} not found in GridFS")
+        stream = await self.bucket.open_download_stream(file._id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.part"
+        out = await run_in_threadpool(open, temp_path, "wb")
+        try:
+            while chunk := await stream.read(CHUNK_SIZE):
+                await run_in_threadpool(out.write, chunk)
+        except BaseException:
+            await run_in_threadpool(out.close)
+            await run_in_threadpool(os.remove, temp_path)
+            raise
+        await run_in_threadpool(out.close)
+        await run_in_threadpool(os.replace, temp_path, path)
+
+    async def delete_prefix(self, prefix: str):
+        async for file in self.bucket.find({"filename": {"$regex": f"^{re.escape(prefix)}"}}):
+            await self.bucket.delete(file._id)
+
+    async def stat(self, path: str):
+        file = await self.latest(storage_key(path))
+        if file is None:
+            return None
+        return StoredFile(file.length, file.upload_date.replace(tzinfo=timezone.utc).timestamp(), f'"{file._id}"')
+
+    async def read(self, path: str, start: int, end: int):
+        # Yields bytes start..end inclusive.
+        file = await self.latest(storage_key(path))
+        if file is None:
+            return
+        stream = await self.bucket.open_download_stream(file._id)
+        stream.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await stream.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    async def check(self):
+        await database.client.admin.command("ping")
+
+
+class S3Storage(RemoteStorage):
+    def __init__(self):
+        if boto3 is None:
+            raise StorageError("STORAGE_BACKEND=s3 needs boto3")
+        if not S3_BUCKET:
+            raise StorageError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        self.client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+
+    async def upload(self, key: str, path: str):
+        await run_in_threadpool(self.client.upload_file, path, S3_BUCKET, S3_PREFIX + key)
+
+    async def download(self, key: str, path: str):
+        await run_in_threadpool(replace_from, lambda temp_path: self.client.download_file(S3_BUCKET, S3_PREFIX + key, temp_path), path)
+
+    async def delete_prefix(self, prefix: str):
+        def delete():
+            # A listing page and a delete_objects batch both hold up to 1000 keys.
+            for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET, Prefix=S3_PREFIX + prefix):
+                keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+                if keys:
+                    self.client.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": keys})
+        await run_in_threadpool(delete)
+
+    async def stat(self, path: str):
+        try:
+            head = await run_in_threadpool(self.client.head_object, Bucket=S3_BUCKET, Key=S3_PREFIX + storage_key(path))
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        return StoredFile(head["ContentLength"], head["LastModified"].timestamp(), head["ETag"])
+
+    async def read(self, path: str, start: int, end: int):
+        response = await run_in_threadpool(self.client.get_object, Bucket=S3_BUCKET, Key=S3_PREFIX + storage_key(path), Range=f"bytes={start}-{end}")
+        body = response["Body"]
+        try:
+            while chunk := await run_in_threadpool(body.read, CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+    async def check(self):
+        await run_in_threadpool(self.client.head_bucket, Bucket=S3_BUCKET)
+
+
+BACKENDS = {"local": LocalStorage, "gridfs": GridFSStorage, "s3": S3Storage}
+
+if STORAGE_BACKEND not in BACKENDS:
+    raise StorageError(f"STORAGE_BACKEND must be one of {', '.join(BACKENDS)}")
+backend = BACKENDS[STORAGE_BACKEND]()
@@ -0,0 +1,117 @@
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, nodes
+from jinja2.ext import Extension
+
+import assets
+import metrics
+
+
+TEMPLATE_DIR = "templates"
+# Compiled templates are kept here between restarts and shared by workers.
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "training-templates"))
+# Re-check template files for edits on every render; for development only.
+TEMPLATE_AUTO_RELOAD = os.environ.get("TEMPLATE_AUTO_RELOAD", "0") == "1"
+TEMPLATE_FRAGMENT_CACHE_SIZE = int(os.environ.get("TEMPLATE_FRAGMENT_CACHE_SIZE", 5000))
+# Fragments are versioned by in-process counters, so other workers' changes are
+# only picked up once the fragment expires.
+TEMPLATE_FRAGMENT_TTL = int(os.environ.get("TEMPLATE_FRAGMENT_TTL", 300))
+
+
+class FragmentCache:
+    # LRU of rendered {% cache %} blocks with a TTL.
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key: tuple, render):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] >= time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        fragment = render()
+        self.entries[key] = (fragment, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return fragment
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+fragment_cache = FragmentCache(TEMPLATE_FRAGMENT_CACHE_SIZE, TEMPLATE_FRAGMENT_TTL)
+
+# ("videos",) or ("user", user_name) -> counter bumped whenever that data changes.
+data_versions = {}
+
+
+def data_version(*key):
+    return data_versions.get(key, 0)
+
+
+def bump(*key):
+    data_versions[key] = data_versions.get(key, 0) + 1
+
+
+def invalidate_user(user_name: str):
+    bump("user", user_name)
+
+
+def invalidate_videos():
+    bump("videos")
+
+
+class FragmentCacheExtension(Extension):
+    # {% cache key, ... %}...{% endcache %}: the block is rendered once per
+    # distinct set of keys. Put a data_version(...) in the keys so the block is
+    # re-rendered when the data behind it changes.
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        keys = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            keys.append(parser.parse_expression())
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        # The call site is part of the key so the same keys in two places don't collide.
+        site = nodes.Const(f"{parser.name}:{lineno}")
+        return nodes.CallBlock(self.call_method("_render", [site, nodes.List(keys)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, site: str, keys: list, caller):
+        return fragment_cache.get_or_render((site, *keys), caller)
+
+
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+
+# The one template environment for the app; every router renders through it.
+env = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=True,
+    auto_reload=TEMPLATE_AUTO_RELOAD,
+    bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+    extensions=[FragmentCacheExtension],
+)
+env.globals["data_version"] = data_version
+templates = Jinja2Templates(env=env)
+assets.register(templates)
+metrics.instrument_templates(templates)
+
+
+def warm():
+    # Compile every template up front so the first request for each page doesn't pay for it.
+    for name in env.list_templates():
+        env.get_template(name)
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import DuplicateKeyError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    db = AsyncMongoMockClient()["train_test"]
+    for name in ("user", "vid", "completion", "group", "job"):
+        monkeypatch.setattr(database, f"{name}_collection", db.get_collection(f"{name}s"))
+    return db
+
+
+def command_event(name: str, duration_ms: float):
+    return SimpleNamespace(command_name=name, database_name="train_test", duration_micros=int(duration_ms * 1000))
+
+
+def test_ensure_indexes_rejects_duplicate_user_names(mock_db):
+    async def run():
+        await database.ensure_indexes()
+        await database.user_collection.insert_one({"user_name": "alice"})
+        with pytest.raises(DuplicateKeyError):
+            await database.user_collection.insert_one({"user_name": "alice"})
+        await database.user_collection.insert_one({"user_name": "bob"})
+
+    asyncio.run(run())
+
+
+def test_ensure_indexes_keeps_migrated_completions_unique(mock_db):
+    async def run():
+        await database.ensure_indexes()
+        completion = {"user_name": "alice", "video": "intro.mp4", "completed_at": 1}
+        # Live completions may repeat; migrated ones may not.
+        await database.completion_collection.insert_one(dict(completion))
+        await database.completion_collection.insert_one(dict(completion))
+        await database.completion_collection.insert_one({**completion, "migrated": True})
+        with pytest.raises(DuplicateKeyError):
+            await database.completion_collection.insert_one({**completion, "migrated": True})
+
+    asyncio.run(run())
+
+
+def test_pool_monitor_counts_connections():
+    monitor = database.PoolMonitor()
+    monitor.connection_created(None)
+    monitor.connection_created(None)
+    monitor.connection_checked_out(None)
+    monitor.connection_checked_out(None)
+    monitor.connection_checked_in(None)
+    monitor.connection_check_out_failed(None)
+    monitor.connection_closed(None)
+    assert monitor.stats() == {"open": 1, "checked_out": 1, "max_checked_out": 2, "checkout_failures": 1, "max_pool_size": database.MONGO_MAX_POOL_SIZE}
+
+
+def test_query_monitor_counts_commands_and_slow_queries():
+    monitor = database.QueryMonitor()
+    monitor.succeeded(command_event("find", 1.5))
+    monitor.succeeded(command_event("find", database.MONGO_SLOW_QUERY_MS + 1))
+    monitor.failed(command_event("insert", 0.5))
+    assert monitor.stats() == {"commands": 3, "failures": 1, "slow": 1, "total_ms": round(1.5 + database.MONGO_SLOW_QUERY_MS + 1 + 0.5, 3)}